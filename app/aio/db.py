@@ -0,0 +1,52 @@
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from app.config.config import DB_USER, DB_PASSWORD, DB_URL, DB_NAME
+from app.db import NEWEST_FIRST, after_key
+from app.metrics.metrics import timed
+
+_db = None
+
+
+def get_db():
+    # created on first use, so the client binds to the loop the server is running
+    global _db
+
+    if _db is None:
+        client = AsyncIOMotorClient("mongodb://"+DB_USER+":"+DB_PASSWORD+"@"+DB_URL+"/"+DB_NAME)
+        _db = client.inflex
+
+    return _db
+
+
+def find_newest(query, after=None, limit=None, fields=None):
+    inflex = get_db()['inflex_test']
+
+    cursor = inflex.find(after_key(query, after), projection=fields).sort(NEWEST_FIRST)
+
+    if limit is not None:
+        cursor = cursor.limit(limit)
+
+    return cursor
+
+
+def get_all(after=None, limit=None, fields=None):
+    return find_newest({}, after, limit, fields)
+
+
+def get_all_by_user(user_id, after=None, limit=None, fields=None):
+    return find_newest({"user_id": user_id}, after, limit, fields)
+
+
+async def get_image_for_user(user_id, image_id, fields=None):
+    """The user's image document, or None. Pass fields to fetch only those."""
+    inflex = get_db()['inflex_test']
+
+    with timed("mongo.get_image_for_user"):
+        return await inflex.find_one({"user_id": user_id, "imid": image_id}, projection=fields)
+
+
+async def user_exists(user_id):
+    inflex = get_db()['users']
+
+    with timed("mongo.user_exists"):
+        return bool(await inflex.find_one({'_id': user_id}))
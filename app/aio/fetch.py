@@ -0,0 +1,41 @@
+import tempfile
+
+import aiohttp
+
+from app.config import config
+from app.metrics.metrics import timed
+from app.web.fetch import CHUNK_SIZE, FetchError, HeaderCheck
+
+
+def create_session():
+    connector = aiohttp.TCPConnector(limit=config.ASYNC_FETCH_CONNECTIONS)
+    timeout = aiohttp.ClientTimeout(connect=config.FETCH_CONNECT_TIMEOUT, sock_read=config.FETCH_READ_TIMEOUT)
+
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+async def fetch(session, url):
+    """The asyncio version of app.web.fetch.fetch, with the same byte and pixel limits."""
+    with timed("fetch"):
+        async with session.get(url) as response:
+            response.raise_for_status()
+
+            if response.content_length is not None and response.content_length > config.FETCH_MAX_BYTES:
+                raise FetchError("{} is {} bytes, over the {} byte limit".format(
+                    url, response.content_length, config.FETCH_MAX_BYTES))
+
+            spool = tempfile.SpooledTemporaryFile(max_size=config.FETCH_SPOOL_BYTES)
+            header = HeaderCheck()
+            total = 0
+
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                total += len(chunk)
+                if total > config.FETCH_MAX_BYTES:
+                    raise FetchError("{} is over the {} byte limit".format(url, config.FETCH_MAX_BYTES))
+
+                header.feed(chunk)
+                spool.write(chunk)
+
+    spool.seek(0)
+
+    return spool
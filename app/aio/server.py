@@ -0,0 +1,244 @@
+"""asyncio server for the read and render paths.
+
+    python -m app.aio.server
+
+Serves history, image documents and filter renditions without a thread per
+request: Mongo is read through motor, originals are fetched with aiohttp,
+and only the decode/filter/encode work goes to the filter pool. Uploads and
+upload status stay on the Flask app, so route those paths there.
+"""
+import asyncio
+
+from aiohttp import web
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+
+from app.aio import db
+from app.aio.fetch import create_session, fetch
+from app.cache.render_cache import render_cache, render_key
+from app.config.config import RENDER_CACHE_MAX_AGE, SWATCH_MAX_AGE, ASYNC_PORT
+from app.filters.batch import get_executor
+from app.filters.encoding import negotiate, MIMETYPES
+from app.filters.render import get_filter, render_original, RENDER_SIZES, RENDER_FIELDS
+from app.metrics.metrics import registry, configure_logging
+from app.web.pagination import page_params, stream_page, dump, InvalidPage
+from app.web.renditions import stored_rendition, store_rendition, filter_entry, is_current
+from app.web.swatches import SWATCH_NAME, swatch_image
+from app.web.util import create_uuid, user_response, USER_RESPONSE_FIELDS
+
+JSON = 'application/json'
+
+# renders in progress by cache key, so concurrent requests for one rendition share a render
+rendering = {}
+
+
+def error(request_uid, message, status):
+    return web.json_response({'_uuid': str(request_uid), 'error': message}, status=status)
+
+
+def stored_response(url):
+    response = web.Response(status=302, headers={'Location': url})
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(RENDER_CACHE_MAX_AGE)
+    response.headers['Vary'] = 'Accept'
+
+    return response
+
+
+def cacheable(response, etag):
+    response.headers['ETag'] = quote_etag(etag)
+    response.headers['Cache-Control'] = 'public, max-age={}'.format(RENDER_CACHE_MAX_AGE)
+    response.headers['Vary'] = 'Accept'
+
+    return response
+
+
+async def stream_docs(request, query, after, limit, fields):
+    response = web.StreamResponse(headers={'Content-Type': JSON})
+    await response.prepare(request)
+
+    if limit is None:
+        # written as the cursor is read, with the client's pace as backpressure
+        await response.write(b'[')
+
+        first = True
+        async for doc in query(after, None, fields):
+            await response.write(((',' if not first else '') + dump(doc)).encode('utf-8'))
+            first = False
+
+        await response.write(b']')
+    else:
+        docs = await query(after, limit + 1, fields).to_list(limit + 1)
+
+        for chunk in stream_page(docs, limit):
+            await response.write(chunk.encode('utf-8'))
+
+    await response.write_eof()
+
+    return response
+
+
+async def get_history(request):
+    request_uid = create_uuid()
+    user_id = request.match_info['user_id']
+
+    if not await db.user_exists(user_id):
+        return error(request_uid, "Invalid user", 404)
+
+    try:
+        after, limit, fields = page_params(request.query)
+    except InvalidPage as e:
+        return error(request_uid, str(e), 400)
+
+    return await stream_docs(request, lambda *args: db.get_all_by_user(user_id, *args), after, limit, fields)
+
+
+async def show_db(request):
+    request_uid = create_uuid()
+
+    try:
+        after, limit, fields = page_params(request.query)
+    except InvalidPage as e:
+        return error(request_uid, str(e), 400)
+
+    return await stream_docs(request, db.get_all, after, limit, fields)
+
+
+async def get_image(request):
+    request_uid = create_uuid()
+
+    img = await db.get_image_for_user(request.match_info['user_id'], request.match_info['image_id'],
+                                      USER_RESPONSE_FIELDS)
+
+    if img is None:
+        return error(request_uid, "Invalid", 404)
+
+    return web.json_response(user_response(img))
+
+
+async def get_image_filter(request):
+    request_uid = create_uuid()
+    filter_id = request.match_info['filter_id']
+
+    img = await db.get_image_for_user(request.match_info['user_id'], request.match_info['image_id'],
+                                      {'_id': 0, 'filtered.all': 1})
+
+    if img is None:
+        return error(request_uid, "Invalid", 404)
+
+    entry = filter_entry(img, filter_id)
+    if entry is None:
+        return error(request_uid, "Invalid filter", 404)
+
+    return web.json_response(entry)
+
+
+async def render(session, user_id, image_id, img_json, filter_class, size, output_format, etag):
+    loop = asyncio.get_event_loop()
+
+    original = await fetch(session, img_json['original_url'])
+    # spooled originals can be on disk, so even reading them back stays off the loop
+    data = await loop.run_in_executor(None, original.read)
+
+    img = await loop.run_in_executor(get_executor(), render_original, filter_class.id(), data, size, output_format)
+    await loop.run_in_executor(None, render_cache.put, etag, img)
+
+    entry = filter_entry(img_json, filter_class.id())
+    if entry is not None and is_current(entry, filter_class):
+        store_rendition(user_id, image_id, filter_class, size, img, output_format)
+
+    return img
+
+
+async def render_once(etag, *args):
+    if etag not in rendering:
+        rendering[etag] = asyncio.ensure_future(render(*args + (etag,)))
+        rendering[etag].add_done_callback(lambda _: rendering.pop(etag, None))
+
+    # shielded, so one client going away doesn't cancel the render for the others
+    return await asyncio.shield(rendering[etag])
+
+
+async def get_image_filter_full(request):
+    request_uid = create_uuid()
+    user_id = request.match_info['user_id']
+    image_id = request.match_info['image_id']
+    filter_id = request.match_info['filter_id']
+    size = request.match_info['size']
+
+    img_json = await db.get_image_for_user(user_id, image_id, RENDER_FIELDS)
+
+    if img_json is None:
+        return error(request_uid, "Invalid", 404)
+
+    filter_obj = get_filter(filter_id)
+    if filter_obj is None or size not in RENDER_SIZES:
+        return error(request_uid, "Invalid filter", 404)
+
+    output_format = negotiate(parse_accept_header(request.headers.get('Accept'), MIMEAccept))
+
+    stored = stored_rendition(img_json, filter_obj, size, output_format)
+    if stored is not None:
+        return stored_response(stored['url'])
+
+    etag = render_key(img_json, filter_obj, size, output_format)
+
+    if parse_etags(request.headers.get('If-None-Match')).contains(etag):
+        return cacheable(web.Response(status=304), etag)
+
+    img = await asyncio.get_event_loop().run_in_executor(None, render_cache.get, etag)
+    if img is None:
+        img = await render_once(etag, request.app['session'], user_id, image_id, img_json, filter_obj, size,
+                                output_format)
+
+    return cacheable(web.Response(body=img, content_type=MIMETYPES[output_format]), etag)
+
+
+async def get_swatch(request):
+    name = request.match_info['name']
+
+    if not SWATCH_NAME.match(name):
+        return error(create_uuid(), "Invalid colour", 404)
+
+    return web.Response(body=swatch_image(name).getvalue(), content_type='image/jpeg',
+                        headers={'Cache-Control': 'public, max-age={}'.format(SWATCH_MAX_AGE)})
+
+
+async def metrics(request):
+    return web.Response(body=registry.expose().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4'})
+
+
+async def allow_any_origin(request, response):
+    response.headers['Access-Control-Allow-Origin'] = '*'
+
+
+async def start_session(app):
+    app['session'] = create_session()
+
+
+async def close_session(app):
+    await app['session'].close()
+
+
+def create_app():
+    app = web.Application()
+
+    # the rendition route goes first, since its path would also match a bare image id
+    app.router.add_get(
+        '/users/{user_id}/images/{image_id:[^_/]+}_{filter_id:[^/]+}_{size:[^_/]+}.jpg', get_image_filter_full)
+    app.router.add_get('/users/{user_id}/images', get_history)
+    app.router.add_get('/users/{user_id}/images/{image_id}', get_image)
+    app.router.add_get('/users/{user_id}/images/{image_id}/{filter_id}', get_image_filter)
+    app.router.add_get('/swatches/{name}.jpg', get_swatch)
+    app.router.add_get('/show', show_db)
+    app.router.add_get('/metrics', metrics)
+
+    app.on_startup.append(start_session)
+    app.on_cleanup.append(close_session)
+    app.on_response_prepare.append(allow_any_origin)
+
+    return app
+
+
+if __name__ == '__main__':
+    configure_logging()
+    web.run_app(create_app(), port=ASYNC_PORT)
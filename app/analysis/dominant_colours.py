@@ -1,73 +1,42 @@
-import datetime
-
-import matplotlib.pyplot as plt
-from PIL import Image
-from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
-from sklearn.cluster import KMeans
-
 import numpy as np
-import cv2
-
-from app.web.util import upload_colour_sample
-
-
-def centroid_histogram(kmeans):
-    # grab the number of different clusters and create a histogram
-    # based on the number of pixels assigned to each cluster
-    numLabels = np.arange(0, len(np.unique(kmeans.labels_)) + 1)
-    (hist, _) = np.histogram(kmeans.labels_, bins=numLabels)
-
-    # normalize the histogram, such that it sums to one
-    hist = hist.astype("float")
-    hist /= hist.sum()
 
-    # return the histogram
-    return hist
+from app.analysis.palette import extract_palette
+from app.web.swatches import swatch_url
 
 
-def plot_colors(hist, centroids):
-    # initialize the bar chart representing the relative frequency
-    # of each of the colors
-    bar = np.zeros((50, 300, 3), dtype="uint8")
-    startX = 0
-
-    # loop over the percentage of each cluster and the color of
-    # each cluster
-    for (percent, color) in zip(hist, centroids):
-        # plot the relative percentage of each cluster
-        endX = startX + (percent * 300)
-        cv2.rectangle(bar, (int(startX), 0), (int(endX), 50),
-                      color.astype("uint8").tolist(), -1)
-        startX = endX
+def blank_array(height, width):
+    return np.zeros((height, width, 3), np.uint8)
 
-    # return the bar chart
-    return bar
 
+def rgb_to_hsv(rgb):
+    """Hue, saturation and value of an (..., 3) array of colours, all at once.
 
-def colour_sample(colour, height=100, width=100):
-    blank_image = blank_array(height, width)
+    Hue and saturation are in [0, 1] and value is in the colours' own range,
+    as with matplotlib's rgb_to_hsv (which this replaces) given 0-255 colours.
+    """
+    rgb = np.asarray(rgb, np.float64)
+    value = rgb.max(axis=-1)
+    delta = value - rgb.min(axis=-1)
+    red, green, blue = rgb[..., 0], rgb[..., 1], rgb[..., 2]
 
-    blank_image[:, :] = (colour[0], colour[1], colour[2])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        saturation = np.where(value > 0, delta / value, 0.0)
+        # the first channel that is the max wins, blue before green before red
+        hue = np.select([blue == value, green == value],
+                        [4.0 + (red - green) / delta, 2.0 + (blue - red) / delta],
+                        (green - blue) / delta)
 
-    img = Image.fromarray(blank_image)
-    plt.imshow(img)
-    plt.show()
+    hue = np.where(delta > 0, (hue / 6.0) % 1.0, 0.0)
 
-    return img
+    return np.stack([hue, saturation, value], axis=-1)
 
 
-def blank_array(height, width):
-    return np.zeros((height, width, 3), np.uint8)
+def vibrance(hsv_colours):
+    return hsv_colours[..., 1] * hsv_colours[..., 2]
 
 
 def sort_by_vibrance(hsv_colours):
-    dimensions = (len(hsv_colours), 1)
-
-    vibrances = np.reshape(hsv_colours[:, 1] * hsv_colours[:, 2], dimensions)
-
-    vib_channel = np.append(hsv_colours, vibrances, axis=1)
-
-    return hsv_colours[vib_channel[:, 3].argsort()[::-1]]
+    return hsv_colours[vibrance(hsv_colours).argsort()[::-1]]
 
 
 def rgb_json(rgb_colour):
@@ -78,10 +47,6 @@ def rgb_json(rgb_colour):
     }
 
 
-# def norm_hsv(colour):
-#     return np.array([colour[2], colour[1] * 100.0, colour[0] * 100.0]).astype(np.uint8)
-
-
 def hsv_json(hsv_colour):
     return {
         "hue": float(hsv_colour[0]),
@@ -90,31 +55,44 @@ def hsv_json(hsv_colour):
     }
 
 
-def get_dom_colours(hist, colours):
-    dominant = []
-    # cols = numpy.uint8(colours)
-    hsv_colours = rgb_to_hsv(colours)
-    most_vib_hsv = sort_by_vibrance(hsv_colours)
-    most_vib = hsv_to_rgb(most_vib_hsv[0]).astype(np.uint8)
+class Palette:
+    """An image's dominant colours as arrays, one row per colour.
+
+    Only turned into the stored JSON by dominant_json and vibrant_json, once
+    nothing else needs to work on it.
+    """
+    __slots__ = ['rgb', 'hsv', 'percent']
 
-    # colour_sample(most_vib)
+    def __init__(self, rgb, percent):
+        self.rgb = np.asarray(rgb, np.uint8)
+        self.hsv = rgb_to_hsv(self.rgb)
+        self.percent = np.asarray(percent, np.float64)
 
-    for (percent, colour) in zip(hist, colours.astype(np.uint8)):
-        hsv = rgb_to_hsv(colour)
-        dominant.append(
+    def most_vibrant(self):
+        return int(vibrance(self.hsv).argmax())
+
+    def dominant_json(self):
+        return [
             {
                 "percent": int(percent * 100),
-                "rgb": rgb_json(colour),
+                "rgb": rgb_json(rgb),
                 "hsv": hsv_json(hsv)
-            })
+            }
+            for (percent, rgb, hsv) in zip(self.percent, self.rgb, self.hsv)
+        ]
 
-    vibrant = {
-        "rgb": rgb_json(most_vib),
-        "hsv": hsv_json(most_vib_hsv[0]),
-        "sample": upload_colour_sample(rgb_json(most_vib))
-    }
+    def vibrant_json(self):
+        index = self.most_vibrant()
+
+        return {
+            "rgb": rgb_json(self.rgb[index]),
+            "hsv": hsv_json(self.hsv[index]),
+            "sample": swatch_url(rgb_json(self.rgb[index]))
+        }
 
-    return vibrant, dominant
+
+def get_dom_colours(hist, colours):
+    return Palette(colours, hist)
 
 
 def analyze(filterable):
@@ -141,21 +119,15 @@ def analyze(filterable):
     # plt.imshow(image)
     # reshape the image to be a list of pixels
     image = image.reshape((image.shape[0] * image.shape[1], 3))
-    # cluster the pixel intensities
-    kmeans = KMeans(n_clusters=5)
-
-    # run analysis
-    kmeans.fit(image)
+    # cluster the binned pixel intensities into a histogram of
+    # dominant colours
+    hist, centroids = extract_palette(image)
 
     # print((datetime.datetime.now() - start))
-    # build a histogram of clusters and then create a figure
-    # representing the number of pixels labeled to each color
-    hist = centroid_histogram(kmeans)
-    # bar = plot_colors(hist, kmeans.cluster_centers_)
     # show our color bart
     # plt.figure()
     # plt.axis("off")
     # plt.imshow(bar)
     # plt.show()
-    return get_dom_colours(hist, kmeans.cluster_centers_)
+    return get_dom_colours(hist, centroids)
     # return "", ""
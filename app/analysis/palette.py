@@ -0,0 +1,87 @@
+import numpy
+
+DEFAULT_CLUSTERS = 5
+
+DEFAULT_BITS = 5
+
+MAX_ITERATIONS = 50
+
+
+def colour_histogram(pixels, bits=DEFAULT_BITS):
+    """Bin an (n, 3) uint8 pixel list into 2^bits levels per channel.
+
+    Returns the mean colour of every occupied bin and its pixel count.
+    """
+    pixels = numpy.asarray(pixels, numpy.uint8).reshape(-1, 3)
+    quantised = (pixels >> (8 - bits)).astype(numpy.intp)
+    index = (quantised[:, 0] << (2 * bits)) | (quantised[:, 1] << bits) | quantised[:, 2]
+
+    bins = 1 << (3 * bits)
+    counts = numpy.bincount(index, minlength=bins)
+    occupied = numpy.nonzero(counts)[0]
+
+    colours = numpy.empty((len(occupied), 3))
+    for c in range(3):
+        colours[:, c] = numpy.bincount(index, weights=pixels[:, c], minlength=bins)[occupied]
+
+    weights = counts[occupied].astype(numpy.float64)
+    colours /= weights[:, numpy.newaxis]
+
+    return colours, weights
+
+
+def squared_distances(points, centroids):
+    return ((points[:, numpy.newaxis, :] - centroids[numpy.newaxis, :, :]) ** 2).sum(axis=2)
+
+
+def seed_centroids(colours, weights, clusters, random):
+    # weighted k-means++ seeding
+    centroids = [colours[random.choice(len(colours), p=weights / weights.sum())]]
+
+    for _ in range(1, clusters):
+        nearest = squared_distances(colours, numpy.array(centroids)).min(axis=1) * weights
+        total = nearest.sum()
+
+        if total == 0:
+            break
+
+        centroids.append(colours[random.choice(len(colours), p=nearest / total)])
+
+    return numpy.array(centroids)
+
+
+def weighted_kmeans(colours, weights, clusters=DEFAULT_CLUSTERS, seed=0):
+    random = numpy.random.RandomState(seed)
+    centroids = seed_centroids(colours, weights, min(clusters, len(colours)), random)
+
+    labels = None
+
+    for _ in range(MAX_ITERATIONS):
+        updated = squared_distances(colours, centroids).argmin(axis=1)
+
+        if labels is not None and numpy.array_equal(updated, labels):
+            break
+
+        labels = updated
+        hist = numpy.bincount(labels, weights=weights, minlength=len(centroids))
+        occupied = hist > 0
+
+        for c in range(3):
+            sums = numpy.bincount(labels, weights=weights * colours[:, c], minlength=len(centroids))
+            # empty clusters keep their previous centre
+            centroids[occupied, c] = sums[occupied] / hist[occupied]
+
+    hist = numpy.bincount(labels, weights=weights, minlength=len(centroids))
+
+    return hist / hist.sum(), centroids
+
+
+def extract_palette(pixels, clusters=DEFAULT_CLUSTERS, bits=DEFAULT_BITS, seed=0):
+    """Dominant colours of an (n, 3) uint8 pixel list.
+
+    Returns the fraction of pixels in each cluster and the cluster centres,
+    in the same form as sklearn's KMeans labels histogram and cluster_centers_.
+    """
+    colours, weights = colour_histogram(pixels, bits)
+
+    return weighted_kmeans(colours, weights, clusters, seed)
@@ -0,0 +1,188 @@
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+from app.config.config import RENDER_CACHE_MEMORY_BYTES, RENDER_CACHE_DIR, RENDER_CACHE_DISK_BYTES, \
+    RENDER_CACHE_RESCAN_SECONDS
+from app.filters.encoding import preset_tag, JPEG
+
+# the prefix of files still being written, which scans skip
+TMP_PREFIX = ".tmp-"
+
+
+def original_hash(img_json):
+    # images uploaded before the hash was stored are keyed by their original url,
+    # which is just as stable since originals are never overwritten
+    if 'original_hash' in img_json:
+        return img_json['original_hash']
+
+    return hashlib.sha1(img_json['original_url'].encode('utf-8')).hexdigest()
+
+
+def render_key(img_json, filter_class, size, format=JPEG):
+    parts = [original_hash(img_json), filter_class.id(), filter_class.version(), size, preset_tag(size, format)]
+
+    return hashlib.sha1("|".join(parts).encode('utf-8')).hexdigest()
+
+
+class MemoryTier:
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+
+            return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.entries:
+                self.total -= len(self.entries.pop(key))
+
+            self.entries[key] = data
+            self.total += len(data)
+
+            while self.total > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total -= len(evicted)
+
+
+class DiskTier:
+    """LRU (by mtime) files in a directory, kept under max_bytes in total.
+
+    Every worker process sharing the directory keeps its own index, so each
+    one rescans the directory before it evicts and at least every
+    RENDER_CACHE_RESCAN_SECONDS. Files written by other processes then count
+    towards the bound and files they evicted drop out of the index. Between
+    scans the directory can run over by what the other processes have
+    written since.
+    """
+
+    def __init__(self, directory, max_bytes, rescan_seconds=RENDER_CACHE_RESCAN_SECONDS):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.rescan_seconds = rescan_seconds
+        self.sizes = None
+        self.scanned = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    def scan(self):
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+
+        for name in os.listdir(self.directory):
+            # another process's write in progress
+            if name.startswith(TMP_PREFIX):
+                continue
+
+            try:
+                stat = os.stat(self.path(name))
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, name, stat.st_size))
+
+        self.sizes = OrderedDict((name, size) for (_, name, size) in sorted(entries))
+        self.total = sum(self.sizes.values())
+        self.scanned = time.monotonic()
+
+    def index(self):
+        # built lazily so importing the module never touches the filesystem
+        if self.sizes is None or time.monotonic() - self.scanned > self.rescan_seconds:
+            self.scan()
+
+        return self.sizes
+
+    def get(self, key):
+        # not in the index may still mean another process has written it since the last scan
+        try:
+            with open(self.path(key), 'rb') as cached:
+                data = cached.read()
+            os.utime(self.path(key))
+        except OSError:
+            with self.lock:
+                if self.index().pop(key, None) is not None:
+                    self.scan()
+
+            return None
+
+        with self.lock:
+            sizes = self.index()
+            self.total += len(data) - sizes.pop(key, 0)
+            sizes[key] = len(data)
+
+        return data
+
+    def put(self, key, data):
+        if len(data) > self.max_bytes:
+            return
+
+        with self.lock:
+            sizes = self.index()
+
+            handle, tmp_path = tempfile.mkstemp(dir=self.directory, prefix=TMP_PREFIX)
+            with os.fdopen(handle, 'wb') as tmp:
+                tmp.write(data)
+            os.replace(tmp_path, self.path(key))
+
+            self.total += len(data) - sizes.pop(key, 0)
+            sizes[key] = len(data)
+
+            if self.total > self.max_bytes:
+                # count what the other processes have written, and forget what they evicted
+                self.scan()
+                sizes = self.sizes
+
+            while self.total > self.max_bytes and sizes:
+                name, size = sizes.popitem(last=False)
+                self.total -= size
+                try:
+                    os.remove(self.path(name))
+                except OSError:
+                    pass
+
+
+class RenderCache:
+    """Two tier (memory LRU, then disk) cache of encoded filter renders."""
+
+    def __init__(self, memory, disk):
+        self.memory = memory
+        self.disk = disk
+
+    def get(self, key):
+        data = self.memory.get(key)
+
+        if data is None:
+            data = self.disk.get(key)
+
+            if data is not None:
+                self.memory.put(key, data)
+
+        return data
+
+    def put(self, key, data):
+        self.memory.put(key, data)
+        self.disk.put(key, data)
+
+
+render_cache = RenderCache(
+    MemoryTier(RENDER_CACHE_MEMORY_BYTES),
+    DiskTier(RENDER_CACHE_DIR, RENDER_CACHE_DISK_BYTES)
+)
@@ -3,13 +3,15 @@ import uuid
 
 import pymongo
 
-from app.config.config import DB_USER, DB_PASSWORD, DB_URL, DB_NAME
+from app.config.config import DB_USER, DB_PASSWORD, DB_URL, DB_NAME, JOB_TTL_SECONDS
+from app.metrics.metrics import instrumented
 
 client = pymongo.MongoClient("mongodb://"+DB_USER+":"+DB_PASSWORD+"@"+DB_URL+"/"+DB_NAME)  # defaults to port 27017
 
 db = client.inflex
 
 
+@instrumented("mongo.create_user")
 def create_user():
     user_id = uuid.uuid4().hex[:10]
 
@@ -28,35 +30,132 @@ def get_all_users():
     return inflex.find()
 
 
+@instrumented("mongo.insert")
 def insert(obj):
-    return db['inflex_test'].insert_one(obj)
+    # batched with other workers' inserts; returns the _id once this document is acknowledged
+    from app.writer import writer
 
+    return writer.insert(obj).result()
 
-def get_all():
+
+NEWEST_FIRST = [("timestamp", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]
+
+
+def after_key(query, after):
+    # keyset pagination: everything strictly older than the (timestamp, _id) of the last item seen
+    if after is None:
+        return query
+
+    timestamp, object_id = after
+
+    return {"$and": [query, {"$or": [
+        {"timestamp": {"$lt": timestamp}},
+        {"timestamp": timestamp, "_id": {"$lt": object_id}}
+    ]}]}
+
+
+# functions that return a cursor aren't instrumented: the query only runs as the cursor is read
+def find_newest(query, after=None, limit=None, fields=None):
+    inflex = db['inflex_test']
+
+    cursor = inflex.find(after_key(query, after), projection=fields).sort(NEWEST_FIRST)
+
+    if limit is not None:
+        cursor = cursor.limit(limit)
+
+    return cursor
+
+
+def get_all(after=None, limit=None, fields=None):
+    return find_newest({}, after, limit, fields)
+
+
+def get_all_by_user(user_id, after=None, limit=None, fields=None):
+    return find_newest({"user_id": user_id}, after, limit, fields)
+
+
+@instrumented("mongo.get_image_for_user")
+def get_image_for_user(user_id, image_id, fields=None):
+    """The user's image document, or None. Pass fields to fetch only those."""
     inflex = db['inflex_test']
 
-    return inflex.find().sort("timestamp", pymongo.DESCENDING)
+    return inflex.find_one({"user_id": user_id, "imid": image_id}, projection=fields)
 
 
-def get_all_by_user(user_id):
+@instrumented("mongo.set_rendition")
+def set_rendition(user_id, image_id, filter_id, version, size, rendition):
     inflex = db['inflex_test']
 
-    return inflex.find({"user_id": user_id}).sort("timestamp", pymongo.DESCENDING)
+    return inflex.update_one(
+        {"user_id": user_id, "imid": image_id, "filtered.all.id": filter_id},
+        {"$set": {
+            "filtered.all.$.version": version,
+            "filtered.all.$.renditions." + size: rendition
+        }})
+
+
+@instrumented("mongo.swatch_exists")
+def swatch_exists(name):
+    return bool(db['colour_samples'].find_one({'_id': name}))
+
+
+@instrumented("mongo.add_swatch")
+def add_swatch(name, url):
+    # upserted, since two workers can upload the same colour at once
+    return db['colour_samples'].update_one({'_id': name}, {'$set': {'url': url}}, upsert=True)
+
+
+@instrumented("mongo.create_job")
+def create_job(job_id, user_id):
+    # recorded before the task is queued, so a poll can tell a queued job from one that never existed
+    return db['jobs'].insert_one({
+        '_id': job_id,
+        'user_id': user_id,
+        'state': 'PENDING',
+        'created_date': datetime.datetime.utcnow()
+    })
+
+
+@instrumented("mongo.update_job")
+def update_job(job_id, state, **fields):
+    return db['jobs'].update_one({'_id': job_id}, {'$set': dict(fields, state=state)})
+
+
+@instrumented("mongo.get_job")
+def get_job(job_id):
+    return db['jobs'].find_one({'_id': job_id})
 
 
-def get_image(user_id, image_id):
+@instrumented("mongo.ensure_indexes")
+def ensure_indexes():
+    """Build the indexes the queries rely on; run once per deploy with ``python -m app.db``.
+
+    Fails if existing documents break the unique (user_id, imid) index; they
+    need cleaning up first.
+    """
     inflex = db['inflex_test']
 
-    return inflex.find({"user_id": user_id, "imid": image_id}).sort("timestamp", pymongo.DESCENDING)
+    inflex.create_index([("user_id", pymongo.ASCENDING), ("imid", pymongo.ASCENDING)], unique=True)
+    inflex.create_index([("user_id", pymongo.ASCENDING)] + NEWEST_FIRST)
+    inflex.create_index(NEWEST_FIRST)
+
+    db['jobs'].create_index("created_date", expireAfterSeconds=JOB_TTL_SECONDS)
 
 
+@instrumented("mongo.user_exists")
 def user_exists(user_id):
     inflex = db['users']
 
     return bool(inflex.find_one({'_id': user_id}))
 
 
+@instrumented("mongo.image_exists")
 def image_exists(user_id, image_id):
     inflex = db['inflex_test']
 
     return bool(inflex.find_one({"user_id": user_id, "imid": image_id}))
+
+
+if __name__ == '__main__':
+    ensure_indexes()
+    print(sorted(db['inflex_test'].index_information()))
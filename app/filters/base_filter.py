@@ -1,10 +1,13 @@
 from io import BytesIO
 
 import numpy
-import requests
-import skimage
-from PIL import ImageEnhance, Image
-from skimage import filters
+from PIL import Image
+
+from app.config.config import FILTER_STRIP_ROWS
+from app.filters.encoding import encode, JPEG
+from app.filters.ops import curve, offset, saturation, blur_sharpen
+from app.filters.registry import filter_registry, ops_version
+from app.web.fetch import open_image, check_pixels, FetchError
 
 DEFAULT_PREVIEW_SIZE = 500
 
@@ -62,15 +65,208 @@ def decrease_channel(channel, x):
     return numpy.clip(channel - x, 0, 1.0)
 
 
-def sharpen(array):
-    blurred = filters.gaussian(array, sigma=10, multichannel=True)
-    final = numpy.clip(array * 1.3 - blurred * 0.3, 0, 1.0)
+def channel_ramp():
+    # every possible uint8 input, as img_as_float would see it, one column per channel
+    return numpy.tile((numpy.arange(256) * (1 / 255.0)).reshape(1, 256, 1), (1, 1, 3))
+
+
+def rgb_histogram(pillow):
+    return numpy.array(pillow.histogram()).reshape(3, 256)
+
+
+def lut_peak(histogram, lut):
+    return max(lut[c][histogram[c] > 0].max() for c in range(3))
+
+
+def normalised_lut(histogram, lut):
+    # float_to_uint8 scales by the image maximum, which for a point op is the
+    # largest curve output among the input values actually present
+    peak = lut_peak(histogram, lut)
+
+    if peak <= 0:
+        return numpy.zeros(lut.shape, numpy.uint8)
+
+    return (lut * 255 / peak).astype(numpy.uint8)
+
+
+def as_rgb(pillow):
+    if pillow.mode != 'RGB':
+        return pillow.convert('RGB')
+
+    return pillow
+
+
+def lookup(array, lut):
+    adjusted = numpy.empty(array.shape, lut.dtype)
+
+    for c in range(3):
+        numpy.take(lut[c], array[:, :, c], out=adjusted[:, :, c], mode='clip')
+
+    return adjusted
+
+
+def sharpen_sigma(scale=1.0, radius=10):
+    # the blur radius is defined at full resolution, so shrink it with the image
+    return radius * scale
+
+
+def blur_factor(sigma):
+    # downsampling by this much keeps the blur on the small grid at sigma >= ~2.5
+    return max(1, int(sigma / 2.5))
+
+
+def blur_halo(sigma):
+    """Rows either side of a pixel that fast_blur reads to compute it."""
+    factor = blur_factor(sigma)
+
+    if factor == 1:
+        # scipy's gaussian_filter radius with its default truncate=4.0
+        return int(4.0 * sigma + 0.5)
+
+    # the small grid gaussian's radius, plus one small row either side for upsampling
+    return factor * (int(4.0 * reduced_sigma(sigma, factor) + 0.5) + 2)
+
+
+def reduced_sigma(sigma, factor):
+    # the box average adds variance (f^2 - 1) / 12 and linear upsampling f^2 / 6,
+    # so the small grid only needs to make up the rest
+    variance = sigma ** 2 - (factor ** 2 - 1) / 12.0 - factor ** 2 / 6.0
+
+    return numpy.sqrt(max(variance, 0)) / factor
+
+
+def along(axis, index):
+    return (slice(None),) * axis + (index,)
+
+
+def downsample(array, factor):
+    # block means, summed one offset at a time so each add runs over contiguous rows
+    small = None
+
+    for row in range(factor):
+        for col in range(factor):
+            block = array[row::factor, col::factor]
+            small = block.copy() if small is None else numpy.add(small, block, out=small)
+
+    return small / numpy.float32(factor * factor)
+
+
+def upsample(small, factor, axis):
+    # linear interpolation between the small pixel centres, clamped at the ends;
+    # the weights only depend on the position within each block of factor pixels
+    length = small.shape[axis]
+    edged = numpy.concatenate([small[along(axis, slice(0, 1))], small, small[along(axis, slice(-1, None))]], axis=axis)
+
+    shape = list(small.shape)
+    shape[axis] *= factor
+    upsampled = numpy.empty(shape, small.dtype)
+
+    for phase in range(factor):
+        position = (phase + 0.5) / factor - 0.5
+        lower = int(numpy.floor(position))
+        weight = numpy.float32(position - lower)
+
+        below = edged[along(axis, slice(1 + lower, 1 + lower + length))]
+        above = edged[along(axis, slice(2 + lower, 2 + lower + length))]
+
+        target = upsampled[along(axis, slice(phase, None, factor))]
+        numpy.multiply(below, 1 - weight, out=target)
+        target += above * weight
+
+    return upsampled
+
+
+def fast_blur(array, sigma, pad_top=True, pad_bottom=True):
+    """Approximate gaussian blur (mode='nearest') of an (h, w, 3) float32 array.
+
+    Large radii are blurred on a grid downsampled by blur_factor(sigma) and
+    linearly upsampled. On [0, 1] images this stays within 6e-3 of the exact
+    gaussian even around hard synthetic edges, which keeps Bridge's output
+    within 1 level of the full-resolution blur (see bench/sharpen.py).
+    Edges are replicated at full resolution, like 'nearest'.
+    pad_top/pad_bottom say whether the array's first/last rows are the real
+    image edge; when they are not, the halo rows supply the context instead.
+    """
+    from scipy import ndimage
+
+    factor = blur_factor(sigma)
+
+    if factor == 1:
+        return ndimage.gaussian_filter(array, (sigma, sigma, 0), mode='nearest')
+
+    height, width = array.shape[:2]
+    pad = blur_halo(sigma)
+    top = pad if pad_top else 0
+    bottom = pad if pad_bottom else 0
+
+    padded_height = -(-(height + top + bottom) // factor) * factor
+    padded_width = -(-(width + 2 * pad) // factor) * factor
+
+    padded = numpy.pad(
+        array,
+        ((top, padded_height - height - top), (pad, padded_width - width - pad), (0, 0)),
+        mode='edge')
+
+    small = downsample(padded, factor)
+
+    blur = reduced_sigma(sigma, factor)
+    small = ndimage.gaussian_filter(small, (blur, blur, 0), mode='nearest')
+
+    # columns first, while there are still only 1/factor of the rows to interpolate
+    blurred = upsample(upsample(small, factor, 1), factor, 0)
+
+    return blurred[top:top + height, pad:pad + width]
+
+
+def sharpen(array, scale=1.0, pad_top=True, pad_bottom=True, radius=10, amount=0.3):
+    blurred = fast_blur(array, sharpen_sigma(scale, radius), pad_top, pad_bottom)
+    final = numpy.clip(array * numpy.float32(1 + amount) - blurred * numpy.float32(amount), 0, 1.0)
 
     return final
 
 
-def filterable_to_rgb(filterable):
-    return split_channels(skimage.img_as_float(filterable.as_array()))
+def strips(height, rows, halo):
+    """(top, bottom, start, end) for each band of rows, with start/end widened by the halo."""
+    for top in range(0, height, rows):
+        bottom = min(top + rows, height)
+
+        yield top, bottom, max(top - halo, 0), min(bottom + halo, height)
+
+
+def curves_sharpen(array, lut, scale=1.0, radius=10, amount=0.3):
+    """Curves then sharpen an (h, w, 3) uint8 array, normalised back to uint8."""
+    return float_to_uint8(sharpen(lookup(array, lut), scale, radius=radius, amount=amount))
+
+
+def strip_curves_sharpen(array, lut, scale=1.0, radius=10, amount=0.3, rows=FILTER_STRIP_ROWS):
+    """curves_sharpen band by band, so no full-size float array is ever held.
+
+    float_to_uint8 needs the maximum of the whole sharpened image before any
+    band can be scaled, so the bands are sharpened twice: once to find it,
+    once to write the output. The result is identical to the full-image path.
+    """
+    height = array.shape[0]
+
+    sigma = sharpen_sigma(scale, radius)
+    factor = blur_factor(sigma)
+    halo = blur_halo(sigma)
+    # bands start on the blur's downsampling grid, so every band sees the same blocks as the full image
+    rows = -(-rows // factor) * factor
+
+    def sharpened(top, bottom, start, end):
+        band = sharpen(lookup(array[start:end], lut), scale, start == 0, end == height, radius, amount)
+
+        return band[top - start:bottom - start]
+
+    bands = list(strips(height, rows, halo))
+    peak = max(sharpened(*band).max() for band in bands)
+
+    final = numpy.empty(array.shape, numpy.uint8)
+    for band in bands:
+        top, bottom = band[:2]
+        final[top:bottom] = (sharpened(*band) * 255 / peak).astype(numpy.uint8)
+
+    return final
 
 
 def square_portrait(height, width):
@@ -111,63 +307,131 @@ def preview_size(size, max_size):
     return (width / (height / max_size)), max_size
 
 
+def square_thumb_bounds(size, thumb_size=DEFAULT_THUMB_SIZE):
+    # bounds that keep the short side at least as big as the square thumb
+    width, height = size
+    scale = max(thumb_size) / min(width, height)
+
+    if scale >= 1:
+        return size
+
+    return int(numpy.ceil(width * scale)), int(numpy.ceil(height * scale))
+
+
+def thumbnail_size(size, bounds):
+    # same sizing rule as PIL's Image.thumbnail
+    width, height = size
+
+    if width > bounds[0]:
+        height = int(max(height * bounds[0] / width, 1))
+        width = int(bounds[0])
+
+    if height > bounds[1]:
+        width = int(max(width * bounds[1] / height, 1))
+        height = int(bounds[1])
+
+    return width, height
+
+
 class Filterable:
 
-    def __init__(self, pillow):
+    def __init__(self, pillow, scale=1.0):
         self.pillow = pillow
+        # size of this image relative to the original it was loaded from
+        self.scale = scale
 
     @classmethod
     def from_url(cls, url):
-        response = requests.get(url=url, stream=True)
-        response.raw.decode_content = True
+        return cls(open_image(url))
+
+    @classmethod
+    def from_bytes(cls, data):
+        try:
+            image = Image.open(BytesIO(data))
+        except Image.DecompressionBombError as e:
+            raise FetchError(str(e))
+
+        check_pixels(image.size)
 
-        return cls(Image.open(response.raw))
+        return cls(image)
 
     @classmethod
     def from_array(cls, opencv):
         return cls(Image.fromarray(opencv))
 
+    def derived(self, pillow, factor=1.0):
+        """A new image made from this one's pixels, at factor times its size, keeping scale relative to the original."""
+        return type(self)(pillow, self.scale * factor)
+
+    def reduce(self, bounds):
+        """Shrink to fit within bounds, before filtering rather than after.
+
+        Call this before the pixels are loaded: JPEGs are then decoded straight
+        at 1/2, 1/4 or 1/8 scale instead of decoding the full image first.
+        """
+        width, height = self.pillow.size
+        target = thumbnail_size((width, height), bounds)
+
+        if target == (width, height):
+            return self
+
+        self.pillow.draft(None, target)
+
+        return self.derived(self.pillow.resize(target, Image.ANTIALIAS), target[0] / width)
+
     def as_array(self):
         return numpy.array(self.pillow).copy()
 
     def thumbnail(self, size=DEFAULT_THUMB_SIZE):
-        thumb = self.pillow.copy()
-        thumb.thumbnail(size, Image.ANTIALIAS)
-
-        return thumb
+        # resize straight from the source rather than thumbnailing a full copy
+        return self.pillow.resize(thumbnail_size(self.pillow.size, size), Image.ANTIALIAS)
 
     def preview(self, max_size=DEFAULT_PREVIEW_SIZE):
         return self.thumbnail(preview_size(self.pillow.size, max_size))
 
     def square_thumb(self, size=DEFAULT_THUMB_SIZE):
-        thumb = self.pillow.copy()
-        square = thumb.crop(square_crop_coords(thumb))
-        square.thumbnail(size, Image.ANTIALIAS)
-
-        return square
-
-    def as_bytes(self):
-        file_obj = BytesIO()
-
-        self.pillow.save(file_obj, 'jpeg')
-
-        return file_obj
+        left, top, right, bottom = square_crop_coords(self.pillow)
+
+        return self.pillow.resize(
+            thumbnail_size((right - left, bottom - top), size),
+            Image.ANTIALIAS,
+            box=(left, top, right, bottom))
+
+    def rendition(self, size):
+        """The image for a rendition size code: (f)ull, (p)review, (t)humb or (s)quare thumb."""
+        if size == "f":
+            return self.pillow
+        if size == "p":
+            return self.preview()
+        if size == "t":
+            return self.thumbnail()
+        if size == "s":
+            return self.square_thumb()
+
+        return None
+
+    def as_bytes(self, size="f", format=JPEG):
+        """Encode with the preset for the rendition size this image is being served as."""
+        return encode(self.pillow, size, format)
 
     def thumb_bytes(self, size=DEFAULT_THUMB_SIZE):
-        return Filterable(self.thumbnail(size)).as_bytes()
+        return Filterable(self.thumbnail(size)).as_bytes("t")
 
     def preview_bytes(self, max_size=DEFAULT_PREVIEW_SIZE):
-        return Filterable(self.preview(max_size)).as_bytes()
+        return Filterable(self.preview(max_size)).as_bytes("p")
 
     def square_thumb_bytes(self, size=DEFAULT_THUMB_SIZE):
-        return Filterable(self.square_thumb(size)).as_bytes()
+        return Filterable(self.square_thumb(size)).as_bytes("s")
 
 
 class BaseFilter:
+    """A filter is an id, a name and a list of ops (see app.filters.ops).
 
-    # from mathplotlib import pyplot as plt
-    # plt.imshow(formatted)
-    # plt.show()
+    Filters are looked up through app.filters.registry rather than by
+    scanning subclasses, so a new filter needs @filter_registry.register.
+    """
+
+    ops = []
 
     @staticmethod
     def id():
@@ -177,13 +441,26 @@ class BaseFilter:
     def name():
         pass
 
-    @staticmethod
-    def apply(filterable):
-        pass
+    @classmethod
+    def version(cls):
+        # a hash of the ops, so any change to a filter's output changes its cache keys
+        return ops_version(cls.ops)
+
+    @classmethod
+    def apply(cls, filterable, shared=None):
+        """Run the compiled ops. Filters applied with the same ``shared`` reuse each other's prefixes."""
+        from app.filters.compiler import run
 
+        return run(filter_registry.compiled(cls), filterable, shared)
 
+
+@filter_registry.register
 class BlackAndWhite(BaseFilter):
 
+    ops = [
+        saturation(0.0)
+    ]
+
     @staticmethod
     def id():
         return "black_and_white"
@@ -192,13 +469,16 @@ class BlackAndWhite(BaseFilter):
     def name():
         return "Black and White"
 
-    @staticmethod
-    def apply(filterable):
-        return Filterable(ImageEnhance.Color(filterable.pillow).enhance(0.0))
-
 
+@filter_registry.register
 class Gotham(BaseFilter):
 
+    ops = [
+        curve('red', BOOST_LOWER),
+        offset('blue', 0.03),
+        curve('blue', GOTHAM_ADJUST)
+    ]
+
     @staticmethod
     def id():
         return "gotham"
@@ -207,22 +487,17 @@ class Gotham(BaseFilter):
     def name():
         return "Gotham"
 
-    @staticmethod
-    def apply(filterable):
-        r, g, b = filterable_to_rgb(filterable)
-
-        final = merge_channels(
-            channel_adjust(r, BOOST_LOWER),
-            g,
-            increase_channel(b, 0.03))
-
-        final[:, :, 2] = channel_adjust(blue_channel(final), GOTHAM_ADJUST)
-
-        return Filterable.from_array(float_to_uint8(final))
-
 
+@filter_registry.register
 class Bridge(BaseFilter):
 
+    ops = [
+        curve('red', BOOST_LOWER),
+        curve('red', GOTHAM_ADJUST),
+        offset('green', -0.03),
+        blur_sharpen(radius=10, amount=0.3)
+    ]
+
     @staticmethod
     def id():
         return "bridge"
@@ -231,24 +506,14 @@ class Bridge(BaseFilter):
     def name():
         return "Bridge"
 
-    @staticmethod
-    def apply(filterable):
-        r, g, b = filterable_to_rgb(filterable)
-
-        r_lower = channel_adjust(r, BOOST_LOWER)
-
-        final = merge_channels(
-            channel_adjust(r_lower, GOTHAM_ADJUST),
-            decrease_channel(g, 0.03),
-            b)
-
-        final = sharpen(final)
-
-        return Filterable.from_array(float_to_uint8(final))
-
 
+@filter_registry.register
 class Brighter(BaseFilter):
 
+    ops = [
+        offset('all', 0.2)
+    ]
+
     @staticmethod
     def id():
         return "brighter"
@@ -256,14 +521,3 @@ class Brighter(BaseFilter):
     @staticmethod
     def name():
         return "Brighter"
-
-    @staticmethod
-    def apply(filterable):
-        r, g, b = filterable_to_rgb(filterable)
-
-        final = merge_channels(
-            increase_channel(r, 0.2),
-            increase_channel(g, 0.2),
-            increase_channel(b, 0.2))
-
-        return Filterable.from_array(float_to_uint8(final))
@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from app.config.config import FILTER_POOL, FILTER_WORKERS
+from app.filters.base_filter import Filterable
+from app.filters.compiler import Shared
+from app.filters.registry import filter_registry
+from app.metrics.metrics import timed, propagate, pixel_class
+
+# rendered for every filter on upload: the square thumb and the preview
+UPLOAD_RENDITIONS = ['s', 'p']
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+
+    if _executor is None:
+        if FILTER_POOL == "process":
+            _executor = ProcessPoolExecutor(max_workers=FILTER_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=FILTER_WORKERS)
+
+    return _executor
+
+
+def render(filter_class, filterable, sizes=UPLOAD_RENDITIONS, shared=None):
+    pixels = pixel_class(filterable.pillow.size)
+
+    with timed("filter", filter=filter_class.id(), pixels=pixels):
+        filtered = filter_class.apply(filterable, shared)
+
+    outputs = {}
+
+    for size in sizes:
+        image = filtered.rendition(size)
+
+        with timed("encode", filter=filter_class.id(), pixels=pixel_class(image.size)):
+            outputs[size] = (image.size, Filterable(image).as_bytes(size))
+
+    return {
+        'id': filter_class.id(),
+        'name': filter_class.name(),
+        'version': filter_class.version(),
+        'outputs': outputs
+    }
+
+
+def render_all(filterable, filters=None, executor=None, sizes=UPLOAD_RENDITIONS):
+    """Apply every filter to one decoded image concurrently and encode the outputs.
+
+    Results come back in the same order as ``filters``, each with an
+    ``outputs`` dict of size code to ((width, height), encoded bytes).
+    """
+    if filters is None:
+        filters = filter_registry.all()
+
+    if executor is None:
+        executor = get_executor()
+
+    # decode once up front so the workers share the pixels instead of racing to load them
+    filterable.pillow.load()
+
+    task = render
+    shared = None
+    if isinstance(executor, ThreadPoolExecutor):
+        # process workers can't report back into this request's breakdown, or share stages
+        task = propagate(render)
+        shared = Shared()
+
+    futures = [executor.submit(task, filter_class, filterable, sizes, shared) for filter_class in filters]
+
+    return [future.result() for future in futures]
@@ -0,0 +1,164 @@
+"""Compiles a filter's ops into stages, and runs them.
+
+Runs of point ops (curves and offsets) become one lookup table, built once
+per process from every possible input value. A blur-sharpen takes the table
+before it along, so the curves and the sharpen happen in one pass with no
+intermediate uint8 image.
+
+Stages are keyed by the ops they came from. Filters applied together with a
+``Shared`` reuse any leading stages they have in common, and always share
+the RGB conversion, histogram and pixel array of the input.
+"""
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+
+import numpy
+from PIL import Image, ImageEnhance
+
+from app.config.config import FILTER_STRIP_ROWS, FILTER_STRIP_THRESHOLD_PIXELS
+from app.filters.base_filter import as_rgb, rgb_histogram, normalised_lut, channel_ramp, \
+    channel_adjust, curves_sharpen, strip_curves_sharpen
+from app.filters.ops import CHANNELS, POINT_OPS, Curve, BlurSharpen, Saturation
+
+
+def point_lut(ops, dtype=numpy.float64):
+    """(3, 256) table of the point ops' output for each channel and input value."""
+    values = channel_ramp()[0]
+
+    for op in ops:
+        for c in CHANNELS[op.channel]:
+            if isinstance(op, Curve):
+                values[:, c] = channel_adjust(values[:, c], op.points)
+            else:
+                values[:, c] = numpy.clip(values[:, c] + op.amount, 0, 1.0)
+
+    return numpy.ascontiguousarray(values.T).astype(dtype)
+
+
+class Source:
+    """A stage's input, with the views of it that stages need worked out at most once."""
+
+    def __init__(self, filterable):
+        self.filterable = filterable
+        self.pillow = filterable.pillow
+        self.scale = filterable.scale
+        # reentrant, since one view can be worked out from another
+        self.lock = threading.RLock()
+        self.views = {}
+
+    def view(self, name, compute):
+        with self.lock:
+            if name not in self.views:
+                self.views[name] = compute()
+
+            return self.views[name]
+
+    def rgb(self):
+        return self.view('rgb', lambda: as_rgb(self.pillow))
+
+    def histogram(self):
+        return self.view('histogram', lambda: rgb_histogram(self.rgb()))
+
+    def array(self):
+        return self.view('array', lambda: numpy.asarray(self.rgb()))
+
+    def derive(self, pillow):
+        # a stage's output keeps the input's scale, so a later sharpen is sized for the original
+        return self.filterable.derived(pillow)
+
+
+class Curves(namedtuple('Curves', ['key', 'lut'])):
+
+    def run(self, source):
+        lut = normalised_lut(source.histogram(), self.lut)
+
+        return source.derive(source.rgb().point(lut.flatten().tolist()))
+
+
+class CurvesSharpen(namedtuple('CurvesSharpen', ['key', 'lut', 'radius', 'amount'])):
+
+    def run(self, source):
+        array = source.array()
+        height, width = array.shape[:2]
+
+        if width * height > FILTER_STRIP_THRESHOLD_PIXELS:
+            final = strip_curves_sharpen(array, self.lut, source.scale, self.radius, self.amount, FILTER_STRIP_ROWS)
+        else:
+            final = curves_sharpen(array, self.lut, source.scale, self.radius, self.amount)
+
+        return source.derive(Image.fromarray(final))
+
+
+class Saturate(namedtuple('Saturate', ['key', 'factor'])):
+
+    def run(self, source):
+        return source.derive(ImageEnhance.Color(source.pillow).enhance(self.factor))
+
+
+def compile_ops(ops):
+    """The stages for a list of ops; each stage's key is the ops it was built from."""
+    stages = []
+    points = []
+
+    def flush():
+        if points:
+            stages.append(Curves(tuple(points), point_lut(points)))
+            del points[:]
+
+    for op in ops:
+        if isinstance(op, POINT_OPS):
+            points.append(op)
+        elif isinstance(op, BlurSharpen):
+            # the blur works in float32, so its curves table does too
+            stages.append(CurvesSharpen(tuple(points) + (op,), point_lut(points, numpy.float32), op.radius, op.amount))
+            del points[:]
+        elif isinstance(op, Saturation):
+            flush()
+            stages.append(Saturate((op,), op.factor))
+        else:
+            raise ValueError("Unknown filter op {!r}".format(op))
+
+    flush()
+
+    return stages
+
+
+class Shared:
+    """Stage outputs shared by the filters of one batch, each computed by whichever asks first."""
+
+    def __init__(self):
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self.lock:
+            future = self.results.get(key)
+            owner = future is None
+
+            if owner:
+                future = self.results[key] = Future()
+
+        if owner:
+            try:
+                future.set_result(compute())
+            except Exception as e:
+                future.set_exception(e)
+
+        return future.result()
+
+
+def run(stages, filterable, shared=None):
+    if shared is None:
+        shared = Shared()
+
+    source = shared.get((), lambda: Source(filterable))
+    result = filterable
+    prefix = ()
+
+    for stage in stages:
+        prefix += (stage.key,)
+        result = shared.get(prefix, lambda: stage.run(source))
+        source = shared.get(prefix + ('source',), lambda: Source(result))
+
+    return result
@@ -0,0 +1,87 @@
+from collections import namedtuple
+from io import BytesIO
+
+from PIL import Image
+
+from app.config.config import JPEG_QUALITY_FULL, JPEG_QUALITY_PREVIEW, JPEG_QUALITY_THUMB, \
+    WEBP_QUALITY_FULL, WEBP_QUALITY_PREVIEW, WEBP_QUALITY_THUMB, ENCODE_WEBP
+
+Preset = namedtuple('Preset', ['format', 'options'])
+
+JPEG = 'jpeg'
+WEBP = 'webp'
+
+MIMETYPES = {JPEG: 'image/jpeg', WEBP: 'image/webp'}
+
+EXTENSIONS = {JPEG: '.jpg', WEBP: '.webp'}
+
+
+def jpeg_preset(quality, progressive):
+    # 4:2:0 chroma subsampling, as pillow's default is only applied below quality 90
+    return Preset(JPEG, {'quality': quality, 'optimize': True, 'progressive': progressive, 'subsampling': 2})
+
+
+def webp_preset(quality):
+    return Preset(WEBP, {'quality': quality, 'method': 4})
+
+
+# progressive only pays off above ~10KB, so thumbnails stay baseline
+PRESETS = {
+    JPEG: {
+        'f': jpeg_preset(JPEG_QUALITY_FULL, True),
+        'p': jpeg_preset(JPEG_QUALITY_PREVIEW, True),
+        't': jpeg_preset(JPEG_QUALITY_THUMB, False),
+        's': jpeg_preset(JPEG_QUALITY_THUMB, False)
+    },
+    WEBP: {
+        'f': webp_preset(WEBP_QUALITY_FULL),
+        'p': webp_preset(WEBP_QUALITY_PREVIEW),
+        't': webp_preset(WEBP_QUALITY_THUMB),
+        's': webp_preset(WEBP_QUALITY_THUMB)
+    }
+}
+
+
+def webp_supported():
+    # pillow only registers the webp encoder when it was built against libwebp
+    Image.init()
+
+    return 'WEBP' in Image.SAVE
+
+
+def preset(size, format=JPEG):
+    return PRESETS[format][size]
+
+
+def preset_tag(size, format=JPEG):
+    """Identifies the encoder settings, so changing a preset changes the cache key."""
+    options = preset(size, format).options
+
+    return format + ":" + ",".join("{}={}".format(name, options[name]) for name in sorted(options))
+
+
+def encode(image, size="f", format=JPEG):
+    """Encode a pillow image with the preset for its rendition size, into a new BytesIO."""
+    encoder = preset(size, format)
+
+    if image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+
+    file_obj = BytesIO()
+    image.save(file_obj, encoder.format, **encoder.options)
+
+    return file_obj
+
+
+def negotiate(accept_mimetypes):
+    """The output format for a request: webp only for clients that name it explicitly.
+
+    A bare ``*/*`` or ``image/*`` is not enough, since plenty of clients send
+    those without being able to decode webp.
+    """
+    if ENCODE_WEBP and webp_supported():
+        for (mimetype, quality) in accept_mimetypes:
+            if mimetype == MIMETYPES[WEBP] and quality > 0:
+                return WEBP
+
+    return JPEG
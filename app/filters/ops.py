@@ -0,0 +1,39 @@
+"""The operations filters are declared as, in the order they are applied.
+
+Curve and Offset are point ops: each output value depends only on the same
+channel's input value, so any run of them compiles to one lookup table.
+"""
+from collections import namedtuple
+
+CHANNELS = {'red': [0], 'green': [1], 'blue': [2], 'all': [0, 1, 2]}
+
+# map a channel through the curve through evenly spaced points, as values in [0, 1]
+Curve = namedtuple('Curve', ['channel', 'points'])
+
+# add to a channel, clipping to [0, 1]
+Offset = namedtuple('Offset', ['channel', 'amount'])
+
+# 0 is greyscale, 1 leaves the colours as they are
+Saturation = namedtuple('Saturation', ['factor'])
+
+# unsharp mask: the image plus amount times its difference from a gaussian blur of radius
+# pixels (at full resolution), normalised so the brightest value is 255
+BlurSharpen = namedtuple('BlurSharpen', ['radius', 'amount'])
+
+POINT_OPS = (Curve, Offset)
+
+
+def curve(channel, points):
+    return Curve(channel, tuple(points))
+
+
+def offset(channel, amount):
+    return Offset(channel, amount)
+
+
+def saturation(factor):
+    return Saturation(factor)
+
+
+def blur_sharpen(radius=10, amount=0.3):
+    return BlurSharpen(radius, amount)
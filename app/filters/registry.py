@@ -0,0 +1,73 @@
+import hashlib
+import importlib
+import threading
+from collections import OrderedDict
+
+# renders stored before versions were hashed say version "1"; they are still
+# current for as long as the filter's ops hash to what they were back then
+LEGACY_VERSIONS = {
+    "black_and_white": "397746bfece3",
+    "gotham": "89495ecacaee",
+    "bridge": "6ec56b2c6c18",
+    "brighter": "df0ee28a0ad4"
+}
+
+
+def ops_version(ops):
+    # namedtuples of strings, numbers and tuples have a stable repr, floats included
+    return hashlib.sha1(repr(tuple(ops)).encode('utf-8')).hexdigest()[:12]
+
+
+class FilterRegistry:
+    """Filters by id, in the order they were registered, with their compiled ops."""
+
+    def __init__(self):
+        self.filters = OrderedDict()
+        self.programs = {}
+        self.lock = threading.Lock()
+
+    def register(self, filter_class):
+        if filter_class.id() in self.filters:
+            raise ValueError("A filter with id {} is already registered".format(filter_class.id()))
+
+        self.filters[filter_class.id()] = filter_class
+
+        return filter_class
+
+    def load(self):
+        # the built in filters register themselves when their module is imported
+        importlib.import_module('app.filters.base_filter')
+
+    def get(self, filter_id):
+        self.load()
+
+        return self.filters.get(filter_id)
+
+    def all(self):
+        self.load()
+
+        return list(self.filters.values())
+
+    def compiled(self, filter_class):
+        """The filter's ops compiled to stages, once per process."""
+        from app.filters.compiler import compile_ops
+
+        program = self.programs.get(filter_class)
+
+        if program is None:
+            with self.lock:
+                program = self.programs.get(filter_class)
+
+                if program is None:
+                    program = self.programs[filter_class] = compile_ops(filter_class.ops)
+
+        return program
+
+    def is_current(self, filter_class, version):
+        if version == filter_class.version():
+            return True
+
+        return version == "1" and LEGACY_VERSIONS.get(filter_class.id()) == filter_class.version()
+
+
+filter_registry = FilterRegistry()
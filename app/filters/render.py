@@ -0,0 +1,59 @@
+from app.filters.base_filter import Filterable, preview_size, square_thumb_bounds, \
+    DEFAULT_PREVIEW_SIZE, DEFAULT_THUMB_SIZE
+from app.filters.encoding import JPEG
+from app.filters.registry import filter_registry
+from app.metrics.metrics import timed, pixel_class
+
+RENDER_SIZES = ['f', 'p', 't', 's']
+
+RENDER_FIELDS = {'_id': 0, 'original_url': 1, 'original_hash': 1, 'filtered.all': 1}
+
+
+def get_filter(filter_id):
+    return filter_registry.get(filter_id)
+
+
+def reduce_for_size(image, size):
+    if size == "p":
+        return image.reduce(preview_size(image.pillow.size, DEFAULT_PREVIEW_SIZE))
+    if size == "t":
+        return image.reduce(DEFAULT_THUMB_SIZE)
+    if size == "s":
+        return image.reduce(square_thumb_bounds(image.pillow.size))
+
+    return image
+
+
+def filter_for_size(filter_class, image, size="f"):
+    with timed("decode", pixels=pixel_class(image.pillow.size)):
+        image = reduce_for_size(image, size)
+        image.pillow.load()
+
+    with timed("filter", filter=filter_class.id(), pixels=pixel_class(image.pillow.size)):
+        filtered = filter_class.apply(image)
+
+    return filtered
+
+
+def do_filter_from_img_json(filter_class, img_json, size="f"):
+    return filter_for_size(filter_class, Filterable.from_url(img_json['original_url']), size)
+
+
+def get_img_for_response(filtered, size, output_format=JPEG):
+    rendition = filtered.rendition(size)
+
+    if rendition is None:
+        return None
+
+    return Filterable(rendition).as_bytes(size, output_format)
+
+
+def render_original(filter_id, original, size, output_format=JPEG):
+    """Encoded bytes of one filter rendition of an original's bytes.
+
+    Takes and returns plain values, so it can be sent to a process pool.
+    """
+    filtered = filter_for_size(get_filter(filter_id), Filterable.from_bytes(original), size)
+
+    with timed("encode", filter=filter_id, pixels=pixel_class(filtered.pillow.size)):
+        return get_img_for_response(filtered, size, output_format).getvalue()
@@ -0,0 +1,219 @@
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+log = logging.getLogger("inflex.requests")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# megapixel classes used as the pixels label, so label values stay few
+PIXEL_CLASSES = ((1, "<1MP"), (4, "1-4MP"), (12, "4-12MP"), (24, "12-24MP"))
+
+
+def pixel_class(size):
+    megapixels = size[0] * size[1] / 1e6
+
+    for (limit, label) in PIXEL_CLASSES:
+        if megapixels < limit:
+            return label
+
+    return ">24MP"
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+
+    pairs = ['{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for (name, value) in zip(names, values)]
+
+    return "{" + ",".join(pairs) + "}"
+
+
+class Histogram:
+
+    def __init__(self, name, description, label_names, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+
+        with self.lock:
+            counts, totals = self.series.setdefault(key, ([0] * len(self.buckets), [0.0, 0]))
+
+            for (i, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+
+            totals[0] += value
+            totals[1] += 1
+
+    def expose(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.description),
+            "# TYPE {} histogram".format(self.name)
+        ]
+
+        with self.lock:
+            for (key, (counts, (total, count))) in sorted(self.series.items()):
+                for (bound, bucket_count) in zip(self.buckets, counts):
+                    labels = format_labels(self.label_names + ("le",), key + (repr(bound),))
+                    lines.append("{}_bucket{} {}".format(self.name, labels, bucket_count))
+
+                labels = format_labels(self.label_names + ("le",), key + ("+Inf",))
+                lines.append("{}_bucket{} {}".format(self.name, labels, count))
+
+                labels = format_labels(self.label_names, key)
+                lines.append("{}_sum{} {}".format(self.name, labels, total))
+                lines.append("{}_count{} {}".format(self.name, labels, count))
+
+        return "\n".join(lines)
+
+
+class Registry:
+
+    def __init__(self):
+        self.histograms = []
+
+    def histogram(self, name, description, label_names, buckets=DEFAULT_BUCKETS):
+        histogram = Histogram(name, description, label_names, buckets)
+        self.histograms.append(histogram)
+
+        return histogram
+
+    def expose(self):
+        return "\n".join(histogram.expose() for histogram in self.histograms) + "\n"
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "inflex_stage_seconds",
+    "Time spent in each stage of serving and processing images.",
+    ["stage", "filter", "pixels"])
+
+_current = threading.local()
+
+
+def current_breakdown():
+    return getattr(_current, 'breakdown', None)
+
+
+@contextmanager
+def timed(stage, **tags):
+    """Time a block into the stage histogram and the current request's breakdown."""
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage, **tags)
+
+        breakdown = current_breakdown()
+        if breakdown is not None:
+            entry = dict(tags, stage=stage, seconds=round(elapsed, 6))
+            breakdown['stages'].append(entry)
+
+
+def timed_iteration(stage, iterable, **tags):
+    """Yield from iterable, recording the time spent waiting on it (a lazy cursor, say) as one stage."""
+    elapsed = 0.0
+    iterator = iter(iterable)
+
+    try:
+        while True:
+            start = time.perf_counter()
+
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+
+            yield item
+    finally:
+        STAGE_SECONDS.observe(elapsed, stage=stage, **tags)
+
+
+def instrumented(stage):
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def propagate(fn):
+    """Carry the calling thread's breakdown into fn when it runs on a pool thread."""
+    breakdown = current_breakdown()
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        previous = current_breakdown()
+        _current.breakdown = breakdown
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _current.breakdown = previous
+
+    return wrapper
+
+
+def note(**fields):
+    breakdown = current_breakdown()
+
+    if breakdown is not None:
+        breakdown.update(fields)
+
+
+def start_breakdown(**fields):
+    _current.breakdown = dict(fields, stages=[], started=time.perf_counter())
+
+
+def finish_breakdown(**fields):
+    """Log the current request's stage timings as one JSON line and stop collecting."""
+    breakdown = current_breakdown()
+    _current.breakdown = None
+
+    if breakdown is None:
+        return
+
+    breakdown.update(fields)
+    breakdown['total_seconds'] = round(time.perf_counter() - breakdown.pop('started'), 6)
+
+    log.info(json.dumps(breakdown, default=str))
+
+
+@contextmanager
+def request_breakdown(**fields):
+    start_breakdown(**fields)
+
+    try:
+        yield
+    finally:
+        finish_breakdown()
+
+
+def configure_logging(level=logging.INFO):
+    # one bare JSON object per line, whatever the root logger is set up to do
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        log.addHandler(handler)
+        log.setLevel(level)
+        log.propagate = False
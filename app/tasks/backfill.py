@@ -0,0 +1,336 @@
+"""Re-render the filters that stored images are missing, or have out of date.
+
+    python -m app.tasks.backfill [--filters gotham bridge] [--checkpoint backfill.json] [--dry-run]
+
+Streams the images collection in _id order. Each image that needs work has
+its original fetched on a thread pool, the filters it needs rendered on a
+process pool, and the outputs uploaded; the entries it rendered are then
+written into filtered.all with bulk_write. Images are written back in _id
+order, and after each write the last _id handled (with everything before it)
+goes to the checkpoint, so a run that is stopped carries on from there when
+started again. Images that failed go to the checkpoint too, and are tried
+again first when the next run starts.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from bson import ObjectId
+from pymongo import UpdateOne, ASCENDING
+
+from app import db
+from app.config.config import BACKFILL_BATCH_SIZE, BACKFILL_FETCH_WORKERS, BACKFILL_RENDER_WORKERS, \
+    BACKFILL_UPLOAD_WORKERS, BACKFILL_REPORT_SECONDS
+from app.filters.registry import filter_registry
+from app.metrics.metrics import log, configure_logging
+from app.tasks.pipeline import Pipeline
+from app.web.renditions import filter_entry, is_current
+
+BACKFILL_FIELDS = {'_id': 1, 'original_url': 1, 'filtered.all': 1}
+
+DEFAULT_CHECKPOINT = "backfill.checkpoint.json"
+
+COUNTERS = ['scanned', 'updated', 'filters_rendered', 'failed']
+
+
+def outdated_filters(img_json, filters):
+    """The ids of the filters the image has no current render of."""
+    outdated = []
+
+    for filter_class in filters:
+        entry = filter_entry(img_json, filter_class.id())
+
+        if entry is None or not is_current(entry, filter_class):
+            outdated.append(filter_class.id())
+
+    return outdated
+
+
+def entry_updates(image_id, entries, rendered):
+    """The updates writing rendered entries into an image's filtered.all.
+
+    Only the rendered entries are written, so nothing else in the array is
+    put back as it was when the image was read. An entry is only replaced
+    while it still has the version it was read with, and a new one only
+    pushed while the image has no entry for that filter, so whatever changed
+    them since (a newer render, another run) is left alone.
+    """
+    versions = {entry['id']: entry.get('version') for entry in entries}
+    replace = {}
+    array_filters = []
+    updates = []
+
+    for entry in rendered:
+        if entry['id'] in versions:
+            name = "f{}".format(len(array_filters))
+            replace["filtered.all.$[{}]".format(name)] = entry
+            # a missing version matches None as well, which covers unversioned entries
+            array_filters.append({name + ".id": entry['id'], name + ".version": versions[entry['id']]})
+        else:
+            updates.append(UpdateOne({'_id': image_id, 'filtered.all.id': {'$ne': entry['id']}},
+                                     {'$push': {'filtered.all': entry}}))
+
+    if replace:
+        updates.insert(0, UpdateOne({'_id': image_id}, {'$set': replace}, array_filters=array_filters))
+
+    return updates
+
+
+def render_filters(filter_ids, original):
+    """Every filter's upload renditions of an original's bytes; run in a pool process."""
+    from app.filters.base_filter import Filterable
+    from app.filters.batch import render, UPLOAD_RENDITIONS
+    from app.filters.compiler import Shared
+
+    image = Filterable.from_bytes(original)
+    image.pillow.load()
+    shared = Shared()
+
+    return [render(filter_registry.get(filter_id), image, UPLOAD_RENDITIONS, shared) for filter_id in filter_ids]
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return None, {name: 0 for name in COUNTERS}, set()
+
+    with open(path) as f:
+        checkpoint = json.load(f)
+
+    return ObjectId(checkpoint['last_id']), {name: checkpoint.get(name, 0) for name in COUNTERS}, \
+        {ObjectId(image_id) for image_id in checkpoint.get('failed_ids', [])}
+
+
+def save_checkpoint(path, last_id, counts, failed_ids):
+    # written aside and renamed, so a crash mid write leaves the previous checkpoint
+    temporary = path + ".tmp"
+
+    checkpoint = dict(counts, last_id=str(last_id), failed_ids=[str(image_id) for image_id in sorted(failed_ids)])
+
+    with open(temporary, "w") as f:
+        json.dump(checkpoint, f)
+
+    os.replace(temporary, path)
+
+
+class Backfill:
+
+    def __init__(self, filters, checkpoint, batch_size=BACKFILL_BATCH_SIZE, fetch_workers=BACKFILL_FETCH_WORKERS,
+                 render_workers=BACKFILL_RENDER_WORKERS, upload_workers=BACKFILL_UPLOAD_WORKERS):
+        self.filters = filters
+        self.checkpoint = checkpoint
+        self.batch_size = batch_size
+        # forked from a server started now, not from this process once the pipeline's threads are
+        # running: a fork taken while one of them holds a lock (metrics, logging, urllib3) deadlocks
+        self.render_pool = ProcessPoolExecutor(max_workers=render_workers,
+                                               mp_context=multiprocessing.get_context("forkserver"))
+        # render threads only hand images to the process pool and wait for them
+        self.pipeline = Pipeline([
+            ('fetching', self.fetch_original, fetch_workers),
+            ('rendering', self.render, render_workers),
+            ('uploading', self.upload, upload_workers)
+        ])
+
+        self.last_id, self.counts, self.failed_ids = load_checkpoint(checkpoint)
+        # (_id, future of its updates or None) in the order read, until written
+        self.pending = deque()
+        # the updates of each image waiting to be written
+        self.updates = []
+        self.handled = 0
+        self.started = time.perf_counter()
+        self.reported = self.started
+        self.counts_at_start = dict(self.counts)
+
+    def fetch_original(self, job):
+        from app.web.fetch import fetch
+
+        job['original'] = fetch(job['original_url']).read()
+
+        return job
+
+    def render(self, job):
+        job['rendered'] = self.render_pool.submit(render_filters, job['filters'], job.pop('original')).result()
+
+        return job
+
+    def upload(self, job):
+        from app.tasks.tasks import upload_renders
+
+        return entry_updates(job['_id'], job['entries'], upload_renders(job.pop('rendered'))), len(job['filters'])
+
+    def images(self, query):
+        return db.db['inflex_test'].find(query, projection=BACKFILL_FIELDS, no_cursor_timeout=True) \
+            .sort('_id', ASCENDING).batch_size(self.batch_size)
+
+    def run(self, limit=None):
+        # the images an earlier run failed on come first, then everything after the checkpoint
+        retries = self.images({'_id': {'$in': sorted(self.failed_ids)}})
+        cursor = self.images({} if self.last_id is None else {'_id': {'$gt': self.last_id}})
+
+        if limit is not None:
+            cursor = cursor.limit(limit)
+
+        try:
+            for img_json in chain(retries, cursor):
+                self.counts['scanned'] += 1
+                filters = outdated_filters(img_json, self.filters)
+
+                if filters:
+                    job = {'_id': img_json['_id'], 'original_url': img_json['original_url'],
+                           'entries': img_json.get('filtered', {}).get('all', []), 'filters': filters}
+                    # blocks while the fetch stage is full, which keeps the originals in memory bounded
+                    self.pending.append((img_json['_id'], self.pipeline.submit(img_json['_id'], job)))
+                else:
+                    self.pending.append((img_json['_id'], None))
+
+                self.collect()
+                self.report()
+
+            self.collect(block=True)
+            self.write()
+        finally:
+            retries.close()
+            cursor.close()
+            self.pipeline.shutdown()
+            self.render_pool.shutdown()
+
+        self.report(final=True)
+
+        return self.counts
+
+    def collect(self, block=False):
+        """Take finished images off the front of the queue, writing updates a batch at a time."""
+        while self.pending:
+            image_id, future = self.pending[0]
+
+            if future is not None and not future.done():
+                if not block:
+                    return
+
+                # write what is ready before blocking on the slowest image
+                self.write_if_due()
+
+                while not future.done():
+                    wait([future], timeout=BACKFILL_REPORT_SECONDS)
+                    self.report()
+
+            self.pending.popleft()
+            # retried images are all before the checkpoint, so it only ever moves forward
+            self.last_id = image_id if self.last_id is None else max(self.last_id, image_id)
+            self.handled += 1
+
+            if future is not None:
+                self.finished(image_id, future)
+
+            self.write_if_due()
+
+    def finished(self, image_id, future):
+        if future.exception() is not None:
+            # kept in the checkpoint, so the next run tries it again
+            self.failed_ids.add(image_id)
+            self.counts['failed'] += 1
+            log.info(json.dumps({'backfill': 'failed', '_id': str(image_id), 'error': str(future.exception())}))
+            return
+
+        updates, filters_rendered = future.result()
+        self.failed_ids.discard(image_id)
+        self.updates.append(updates)
+        self.counts['filters_rendered'] += filters_rendered
+
+    def write_if_due(self):
+        if self.handled >= self.batch_size:
+            self.write()
+
+    def write(self):
+        if self.updates:
+            db.db['inflex_test'].bulk_write([update for updates in self.updates for update in updates], ordered=False)
+            self.counts['updated'] += len(self.updates)
+            self.updates = []
+
+        if self.last_id is not None:
+            save_checkpoint(self.checkpoint, self.last_id, self.counts, self.failed_ids)
+
+        self.handled = 0
+
+    def report(self, final=False):
+        now = time.perf_counter()
+
+        if not final and now - self.reported < BACKFILL_REPORT_SECONDS:
+            return
+
+        self.reported = now
+        elapsed = now - self.started
+        done = {name: self.counts[name] - self.counts_at_start[name] for name in COUNTERS}
+
+        log.info(json.dumps(dict(
+            self.counts,
+            backfill='finished' if final else 'progress',
+            in_flight=sum(1 for (_, future) in self.pending if future is not None),
+            last_id=str(self.last_id),
+            elapsed_seconds=round(elapsed, 1),
+            scanned_per_second=round(done['scanned'] / elapsed, 2),
+            updated_per_second=round(done['updated'] / elapsed, 2),
+            filters_per_second=round(done['filters_rendered'] / elapsed, 2))))
+
+
+def dry_run(filters, limit=None):
+    """How many images each filter would be rendered for, without fetching anything."""
+    cursor = db.db['inflex_test'].find({}, projection=BACKFILL_FIELDS)
+
+    if limit is not None:
+        cursor = cursor.limit(limit)
+
+    counts = {'scanned': 0, 'outdated': 0, 'filters': {filter_class.id(): 0 for filter_class in filters}}
+
+    for img_json in cursor:
+        outdated = outdated_filters(img_json, filters)
+        counts['scanned'] += 1
+        counts['outdated'] += 1 if outdated else 0
+
+        for filter_id in outdated:
+            counts['filters'][filter_id] += 1
+
+    return counts
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Re-render outdated or missing filters of stored images.")
+    parser.add_argument("--filters", nargs="+", help="filter ids to bring up to date (default: all)")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and start from the beginning")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--fetch-workers", type=int, default=BACKFILL_FETCH_WORKERS)
+    parser.add_argument("--render-workers", type=int, default=BACKFILL_RENDER_WORKERS)
+    parser.add_argument("--upload-workers", type=int, default=BACKFILL_UPLOAD_WORKERS)
+    parser.add_argument("--limit", type=int, help="stop after this many images")
+    parser.add_argument("--dry-run", action="store_true", help="only count what would be rendered")
+    args = parser.parse_args(argv)
+
+    configure_logging()
+
+    if args.filters:
+        filters = [filter_registry.get(filter_id) for filter_id in args.filters]
+
+        if None in filters:
+            parser.error("unknown filter in {}".format(", ".join(args.filters)))
+    else:
+        filters = filter_registry.all()
+
+    if args.dry_run:
+        print(json.dumps(dry_run(filters, args.limit), indent=2))
+        return
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+    Backfill(filters, args.checkpoint, args.batch_size, args.fetch_workers, args.render_workers,
+             args.upload_workers).run(args.limit)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
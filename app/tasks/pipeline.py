@@ -0,0 +1,188 @@
+"""Pipelined processing for batch uploads.
+
+Every image goes through the same stages in order, but each stage has its
+own bounded pool, so while one image is being filtered the next is being
+analysed and the one before is uploading. A stage only takes on as many
+images as it has room for, which holds the pipeline (and the decoded images
+in it) back when a later stage is the bottleneck.
+"""
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+
+from app import db
+from app.config.config import BATCH_ORIGINAL_WORKERS, BATCH_ANALYZE_WORKERS, BATCH_FILTER_WORKERS, \
+    BATCH_UPLOAD_WORKERS
+from app.metrics.metrics import timed, propagate, pixel_class
+from app.writer import writer
+
+PENDING = 'PENDING'
+SUCCESS = 'SUCCESS'
+FAILURE = 'FAILURE'
+
+# how often the batch reports progress while it waits
+PROGRESS_INTERVAL = 1.0
+
+
+class Stage:
+
+    def __init__(self, name, fn, workers):
+        self.name = name
+        self.fn = fn
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        # the images running plus as many again waiting for a worker
+        self.slots = threading.BoundedSemaphore(workers * 2)
+
+
+class Pipeline:
+    """Runs items through (name, fn, workers) stages in order; each fn gets the last one's result."""
+
+    def __init__(self, stages, on_stage=lambda key, name: None):
+        self.stages = [Stage(name, fn, workers) for (name, fn, workers) in stages]
+        self.on_stage = on_stage
+
+    def run(self, items):
+        """A future per (key, item) pair, with the last stage's result or the first error."""
+        return [self.submit(key, item) for (key, item) in items]
+
+    def submit(self, key, item):
+        """Start one item down the pipeline, blocking while the first stage is full."""
+        result = Future()
+        self.start(0, key, item, result)
+
+        return result
+
+    def start(self, index, key, value, result):
+        stage = self.stages[index]
+
+        # blocks while the stage is full; that is the backpressure
+        stage.slots.acquire()
+
+        def call():
+            self.on_stage(key, stage.name)
+
+            return stage.fn(value)
+
+        future = stage.executor.submit(call)
+        future.add_done_callback(lambda done: self.finish(index, key, done, result))
+
+    def finish(self, index, key, done, result):
+        self.stages[index].slots.release()
+
+        if done.exception() is not None:
+            result.set_exception(done.exception())
+        elif index + 1 == len(self.stages):
+            result.set_result(done.result())
+        else:
+            self.start(index + 1, key, done.result(), result)
+
+    def shutdown(self):
+        for stage in self.stages:
+            stage.executor.shutdown(wait=False)
+
+
+def fetch_original(job):
+    from app.web.fetch import fetch
+    from app.web.uploader import uploader
+
+    # the web process put the original in the bucket, so only its bytes need to come back
+    job['original_url'] = uploader.url(job['key'])
+    job['original'] = fetch(job['original_url']).read()
+
+    return job
+
+
+def analyze_original(job):
+    from app.analysis.dominant_colours import analyze
+    from app.filters.base_filter import Filterable
+
+    image = Filterable.from_bytes(job['original'])
+    pixels = pixel_class(image.pillow.size)
+
+    with timed('decode', pixels=pixels):
+        image.pillow.load()
+
+    with timed('analyze', pixels=pixels):
+        job['palette'] = analyze(image)
+
+    job['original_hash'] = hashlib.sha1(job.pop('original')).hexdigest()
+    job['image'] = image
+
+    return job
+
+
+def render_filters(job):
+    from app.filters.batch import render_all
+
+    job['rendered'] = render_all(job.pop('image'))
+
+    return job
+
+
+def store_filters(job):
+    from app.tasks.tasks import upload_renders, image_document
+
+    filtered_images = upload_renders(job.pop('rendered'))
+
+    db.insert(image_document(job['imid'], job['original_url'], job['original_hash'], job['palette'], filtered_images,
+                             job['request_uid'], job['user_id']))
+
+    return job['imid']
+
+
+def run_batch(images, request_uid, user_id, progress=lambda states: None):
+    """Process a batch of images, each {imid, key} of an original already in the bucket.
+
+    Returns a {imid, status[, error]} per image, in order. One image failing
+    does not stop the others.
+    """
+    states = {image['imid']: PENDING for image in images}
+
+    def on_stage(imid, name):
+        states[imid] = name
+
+    pipeline = Pipeline([
+        ('fetching_original', propagate(fetch_original), BATCH_ORIGINAL_WORKERS),
+        ('analyzing', propagate(analyze_original), BATCH_ANALYZE_WORKERS),
+        ('filtering', propagate(render_filters), BATCH_FILTER_WORKERS),
+        ('saving', propagate(store_filters), BATCH_UPLOAD_WORKERS)
+    ], on_stage)
+
+    jobs = [dict(image, request_uid=request_uid, user_id=user_id) for image in images]
+
+    # the saving stage's inserts can share a batch, so the writer holds one open for them
+    with writer.batching():
+        try:
+            # started from a thread of its own, since filling the first stage can block
+            starter = ThreadPoolExecutor(max_workers=1)
+            started = starter.submit(pipeline.run, [(job['imid'], job) for job in jobs])
+
+            while not started.done():
+                progress(dict(states))
+                wait([started], timeout=PROGRESS_INTERVAL)
+
+            futures = started.result()
+            starter.shutdown()
+
+            while True:
+                done, pending = wait(futures, timeout=PROGRESS_INTERVAL)
+
+                for (job, future) in zip(jobs, futures):
+                    if future in done:
+                        states[job['imid']] = FAILURE if future.exception() is not None else SUCCESS
+
+                if not pending:
+                    break
+
+                progress(dict(states))
+        finally:
+            pipeline.shutdown()
+
+    results = []
+    for (job, future) in zip(jobs, futures):
+        if future.exception() is not None:
+            results.append({'imid': job['imid'], 'status': FAILURE, 'error': str(future.exception())})
+        else:
+            results.append({'imid': job['imid'], 'status': SUCCESS})
+
+    return results
@@ -0,0 +1,106 @@
+import tempfile
+
+import requests
+from PIL import Image, ImageFile
+from requests.adapters import HTTPAdapter
+
+from app.config import config
+from app.metrics.metrics import instrumented
+
+CHUNK_SIZE = 64 * 1024
+
+# PIL's own decompression bomb guard, for images that arrive any other way
+Image.MAX_IMAGE_PIXELS = config.FETCH_MAX_PIXELS
+
+
+class FetchError(Exception):
+    pass
+
+
+def create_session():
+    adapter = HTTPAdapter(pool_connections=config.FETCH_POOL_SIZE, pool_maxsize=config.FETCH_POOL_SIZE)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+session = create_session()
+
+
+def check_pixels(size):
+    width, height = size
+
+    if width * height > config.FETCH_MAX_PIXELS:
+        raise FetchError("Image is {}x{}, over the {} pixel limit".format(width, height, config.FETCH_MAX_PIXELS))
+
+
+class HeaderCheck:
+    """Rejects an image by its dimensions as soon as its header has streamed in."""
+
+    def __init__(self):
+        self.parser = ImageFile.Parser()
+        self.peeked = 0
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return
+
+        try:
+            self.parser.feed(chunk)
+        except Image.DecompressionBombError as e:
+            raise FetchError(str(e))
+
+        self.peeked += len(chunk)
+
+        if self.parser.image is not None:
+            check_pixels(self.parser.image.size)
+            self.done = True
+        elif self.peeked >= config.FETCH_HEADER_BYTES:
+            # no header where one should be: leave it to PIL once the whole body is here
+            self.done = True
+
+
+@instrumented("fetch")
+def fetch(url):
+    """Download url into a spooled temp file, enforcing the timeout, byte and pixel limits."""
+    response = session.get(url, stream=True, timeout=(config.FETCH_CONNECT_TIMEOUT, config.FETCH_READ_TIMEOUT))
+
+    try:
+        response.raise_for_status()
+
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) > config.FETCH_MAX_BYTES:
+            raise FetchError("{} is {} bytes, over the {} byte limit".format(url, length, config.FETCH_MAX_BYTES))
+
+        spool = tempfile.SpooledTemporaryFile(max_size=config.FETCH_SPOOL_BYTES)
+        header = HeaderCheck()
+        total = 0
+
+        for chunk in response.iter_content(CHUNK_SIZE):
+            total += len(chunk)
+            if total > config.FETCH_MAX_BYTES:
+                raise FetchError("{} is over the {} byte limit".format(url, config.FETCH_MAX_BYTES))
+
+            header.feed(chunk)
+            spool.write(chunk)
+    finally:
+        response.close()
+
+    spool.seek(0)
+
+    return spool
+
+
+def open_image(url):
+    try:
+        image = Image.open(fetch(url))
+    except Image.DecompressionBombError as e:
+        raise FetchError(str(e))
+
+    check_pixels(image.size)
+
+    return image
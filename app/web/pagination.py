@@ -0,0 +1,96 @@
+import base64
+import json
+
+from bson import ObjectId
+from bson.errors import InvalidId
+
+from app.config.config import PAGE_MAX_LIMIT
+from app.metrics.metrics import timed_iteration
+
+
+class InvalidPage(Exception):
+    pass
+
+
+def encode_cursor(doc):
+    key = json.dumps([doc['timestamp'], str(doc['_id'])])
+
+    return base64.urlsafe_b64encode(key.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        timestamp, object_id = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+
+        return timestamp, ObjectId(object_id)
+    except (ValueError, TypeError, InvalidId):
+        raise InvalidPage("Invalid cursor")
+
+
+def page_params(args):
+    """(after, limit, fields) from the limit/cursor/fields query parameters."""
+    after = decode_cursor(args['cursor']) if 'cursor' in args else None
+
+    limit = None
+    if 'limit' in args or after is not None:
+        try:
+            limit = min(int(args.get('limit', PAGE_MAX_LIMIT)), PAGE_MAX_LIMIT)
+        except ValueError:
+            raise InvalidPage("Invalid limit")
+
+        if limit < 1:
+            raise InvalidPage("Invalid limit")
+
+    fields = None
+    if args.get('fields'):
+        # the cursor needs the sort key back, whatever else was asked for
+        fields = dict.fromkeys(args['fields'].split(','), 1)
+        fields['timestamp'] = 1
+
+    return after, limit, fields
+
+
+def dump(doc):
+    doc['_id'] = str(doc['_id'])
+
+    return json.dumps(doc)
+
+
+def stream_array(docs):
+    yield '['
+
+    for (i, doc) in enumerate(docs):
+        yield (',' if i else '') + dump(doc)
+
+    yield ']'
+
+
+def stream_page(docs, limit):
+    """A {"items": [...], "next_cursor": ...} page, written out as the cursor is read.
+
+    ``docs`` must be queried with ``limit + 1`` so a following page can be detected.
+    """
+    yield '{"items":['
+
+    last = None
+    next_cursor = None
+
+    for (i, doc) in enumerate(docs):
+        if i == limit:
+            next_cursor = encode_cursor(last)
+            break
+
+        last = {'timestamp': doc.get('timestamp'), '_id': doc['_id']}
+        yield (',' if i else '') + dump(doc)
+
+    yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+
+
+def stream_docs(query, after, limit, fields):
+    """Stream ``query(after, limit, fields)`` as a plain array, or as a page once a limit applies."""
+    # the query runs while the response streams, after the request's breakdown has been logged,
+    # so reading the cursor is timed into the stage histogram on its own
+    if limit is None:
+        return stream_array(timed_iteration("mongo.stream_docs", query(after, None, fields)))
+
+    return stream_page(timed_iteration("mongo.stream_docs", query(after, limit + 1, fields)), limit)
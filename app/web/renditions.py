@@ -0,0 +1,105 @@
+import json
+import threading
+
+from app import db
+from app.filters.base_filter import Filterable
+from app.filters.encoding import JPEG, EXTENSIONS, MIMETYPES
+from app.filters.registry import filter_registry
+from app.metrics.metrics import log
+from app.web.uploader import uploader, upload_item
+from app.web.util import random_file_name
+
+# renditions being stored right now, so concurrent misses upload only one copy
+storing = set()
+storing_lock = threading.Lock()
+
+# renditions stored before the manifest existed, by the url field they were kept in
+LEGACY_URLS = {'s': 'thumb_url', 'p': 'preview_url'}
+
+
+def rendition_name(size, format=JPEG):
+    # jpeg renditions keep the bare size code they were always stored under
+    if format == JPEG:
+        return size
+
+    return "{}_{}".format(size, format)
+
+
+def rendition_entry(url, dimensions, format=JPEG):
+    width, height = dimensions
+
+    return {
+        'url': url,
+        'format': format,
+        'width': width,
+        'height': height
+    }
+
+
+def filter_entry(img_json, filter_id):
+    for entry in img_json.get('filtered', {}).get('all', []):
+        if entry['id'] == filter_id:
+            return entry
+
+    return None
+
+
+def entry_renditions(entry):
+    renditions = dict(entry.get('renditions', {}))
+
+    for (size, field) in LEGACY_URLS.items():
+        if size not in renditions and entry.get(field):
+            renditions[size] = {'url': entry[field], 'format': 'jpeg'}
+
+    return renditions
+
+
+def is_current(entry, filter_class):
+    # entries written before filters were versioned came from version "1"
+    return filter_registry.is_current(filter_class, entry.get('version', "1"))
+
+
+def stored_rendition(img_json, filter_class, size, format=JPEG):
+    """The stored rendition for this filter, size and format, if it is still current."""
+    entry = filter_entry(img_json, filter_class.id())
+
+    if entry is None or not is_current(entry, filter_class):
+        return None
+
+    return entry_renditions(entry).get(rendition_name(size, format))
+
+
+def store_rendition(user_id, image_id, filter_class, size, data, format=JPEG):
+    """Upload a rendered size and record it in the image's manifest, off the request thread.
+
+    Returns the future of the store, or None when the same rendition is already being stored.
+    """
+    key = (user_id, image_id, filter_class.id(), size, format)
+
+    with storing_lock:
+        if key in storing:
+            return None
+
+        storing.add(key)
+
+    def store():
+        dimensions = Filterable.from_bytes(data).pillow.size
+        url = uploader.upload(upload_item(data, "filtered", random_file_name(EXTENSIONS[format]), MIMETYPES[format]))
+
+        db.set_rendition(user_id, image_id, filter_class.id(), filter_class.version(), rendition_name(size, format),
+                         rendition_entry(url, dimensions, format))
+
+    def stored(future):
+        with storing_lock:
+            storing.discard(key)
+
+        if future.exception() is not None:
+            # the render was still served; the next miss renders and tries storing it again
+            log.warning(json.dumps({'store_rendition': 'failed', 'user_id': user_id, 'imid': image_id,
+                                    'filter': filter_class.id(), 'size': size, 'format': format,
+                                    'error': str(future.exception())}))
+
+    future = uploader.executor.submit(store)
+    future.add_done_callback(stored)
+
+    return future
@@ -0,0 +1,97 @@
+import json
+import re
+import threading
+
+from app import db
+from app.config import config
+from app.metrics.metrics import log
+from app.web.uploader import uploader, upload_item
+from app.web.util import colour_sample
+
+SWATCH_FOLDER = "sample/colour"
+
+SWATCH_NAME = re.compile(r'^[0-9a-f]{6}$')
+
+# swatches known to be in S3 already, so repeat colours skip even the Mongo lookup
+uploaded = set()
+
+# name to the future of the upload in progress, so concurrent callers share one
+pending = {}
+pending_lock = threading.Lock()
+
+
+def quantise(channel):
+    step = config.SWATCH_STEP
+
+    return min(255, int(round(channel / step)) * step)
+
+
+def swatch_name(colour):
+    """The six digit hex name of a {red, green, blue} colour, after quantising."""
+    return "{:02x}{:02x}{:02x}".format(quantise(colour['red']), quantise(colour['green']), quantise(colour['blue']))
+
+
+def swatch_colour(name):
+    return {'red': int(name[0:2], 16), 'green': int(name[2:4], 16), 'blue': int(name[4:6], 16)}
+
+
+def swatch_image(name):
+    return colour_sample(swatch_colour(name))
+
+
+def upload_swatch(name):
+    url = uploader.upload(upload_item(swatch_image(name), SWATCH_FOLDER, name + ".jpg", 'image/jpeg'))
+    db.add_swatch(name, url)
+
+    return url
+
+
+def ensure_swatch(name):
+    if not db.swatch_exists(name):
+        upload_swatch(name)
+
+    uploaded.add(name)
+
+    return swatch_key_url(name)
+
+
+def swatch_key_url(name):
+    return uploader.url("{}/{}.jpg".format(SWATCH_FOLDER, name))
+
+
+def ensured(name, future):
+    with pending_lock:
+        pending.pop(name, None)
+
+    if future.exception() is not None:
+        log.warning(json.dumps({'swatch': 'failed', 'name': name, 'error': str(future.exception())}))
+
+
+def swatch_url(colour):
+    """The url of a colour's sample, or None if it could not be uploaded.
+
+    With SWATCH_BASE_URL set, samples are served by the /swatches endpoint
+    and nothing is uploaded. Otherwise a url is only handed out once its
+    object is known to be in S3. A colour not seen before waits for its
+    upload, which concurrent callers share.
+    """
+    name = swatch_name(colour)
+
+    if config.SWATCH_BASE_URL:
+        return "{}/swatches/{}.jpg".format(config.SWATCH_BASE_URL.rstrip('/'), name)
+
+    if name in uploaded:
+        return swatch_key_url(name)
+
+    with pending_lock:
+        future = pending.get(name)
+
+        if future is None:
+            future = pending[name] = uploader.executor.submit(ensure_swatch, name)
+            future.add_done_callback(lambda done: ensured(name, done))
+
+    try:
+        return future.result()
+    except Exception:
+        # logged once by ensured; a sample missing from the document beats one pointing nowhere
+        return None
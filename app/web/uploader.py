@@ -0,0 +1,99 @@
+import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from app.config import config
+from app.metrics.metrics import instrumented, propagate
+
+UploadItem = namedtuple('UploadItem', ['data', 'key', 'content_type'])
+
+UploadResult = namedtuple('UploadResult', ['url', 'error'])
+
+
+class UploadError(Exception):
+
+    def __init__(self, results):
+        self.results = results
+        failed = [result.error for result in results if result.error is not None]
+
+        super().__init__("{} of {} uploads failed: {}".format(len(failed), len(results), failed[0]))
+
+
+def upload_item(data, folder, filename, content_type):
+    return UploadItem(data, os.path.join(folder, filename), content_type)
+
+
+class S3Uploader:
+    """Uploads batches of objects concurrently over one shared S3 client.
+
+    ``client`` only needs ``upload_fileobj``, so a fake or a moto-backed
+    client can be passed in place of the real one.
+    """
+
+    def __init__(self, client=None, bucket=None, location=None, workers=None, acl="public-read"):
+        self.client = client
+        self.bucket = bucket or config.S3_BUCKET
+        self.location = location or config.S3_LOCATION
+        self.acl = acl
+        self.executor = ThreadPoolExecutor(max_workers=workers or config.S3_UPLOAD_WORKERS)
+
+    def get_client(self):
+        if self.client is None:
+            import boto3
+            from botocore.config import Config
+
+            self.client = boto3.client(
+                "s3",
+                aws_access_key_id=config.S3_KEY,
+                aws_secret_access_key=config.S3_SECRET,
+                config=Config(
+                    max_pool_connections=config.S3_MAX_POOL_CONNECTIONS,
+                    retries={'max_attempts': config.S3_MAX_ATTEMPTS}
+                )
+            )
+
+        return self.client
+
+    def url(self, key):
+        return "{}{}".format(self.location, key)
+
+    @instrumented("s3_upload")
+    def upload(self, item):
+        data = item.data
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = BytesIO(data)
+
+        data.seek(0)
+        self.get_client().upload_fileobj(
+            data,
+            self.bucket,
+            item.key,
+            ExtraArgs={
+                "ACL": self.acl,
+                "ContentType": item.content_type
+            }
+        )
+
+        return self.url(item.key)
+
+    def try_upload(self, item):
+        try:
+            return UploadResult(self.upload(item), None)
+        except Exception as e:
+            return UploadResult(None, e)
+
+    def upload_all(self, items):
+        """Upload every item, returning an UploadResult per item in the same order."""
+        return list(self.executor.map(propagate(self.try_upload), items))
+
+    def upload_all_or_raise(self, items):
+        results = self.upload_all(items)
+
+        if any(result.error is not None for result in results):
+            raise UploadError(results)
+
+        return [result.url for result in results]
+
+
+uploader = S3Uploader()
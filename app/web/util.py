@@ -1,59 +1,29 @@
 import os
 import uuid
-from io import BytesIO
 
 import numpy as np
 import requests
 from PIL import Image
 
 from app.config import config
-from app.helpers import s3
-
-
-def upload_fileobj_to_s3(file_bytes, filename, content_type, bucket_name, folder="upload", acl="public-read"):
-    upload_path = os.path.join(folder, filename)
-    try:
-        s3.upload_fileobj(
-            file_bytes,
-            bucket_name,
-            upload_path,
-            ExtraArgs={
-                "ACL": acl,
-                "ContentType": content_type
-            }
-        )
-
-    except Exception as e:
-        # This is a catch all exception, edit this part to fit your needs.
-        print("Something Happened: ", e)
-        return e
+from app.filters.encoding import encode
+from app.web.uploader import uploader, upload_item
 
-    return "{}{}".format(config.S3_LOCATION, upload_path)
 
+def original_folder(user_id):
+    # originals are kept per user, which is what lets a batch name them by key
+    return "originals/{}".format(user_id)
 
-def upload_original(uploaded_file):
-    upload_url = upload_fileobj_to_s3(
-        uploaded_file,
-        random_file_name(os.path.splitext(uploaded_file.filename)[1]),
-        uploaded_file.mimetype,
-        config.S3_BUCKET,
-        "originals"
-    )
 
-    return upload_url
+def upload_originals(user_id, files):
+    """Upload a request's files (streamed, not read into memory) as the user's originals; returns their keys."""
+    items = [upload_item(file.stream, original_folder(user_id), random_file_name(os.path.splitext(file.filename)[1]),
+                         file.mimetype)
+             for file in files]
 
+    uploader.upload_all_or_raise(items)
 
-def upload_object(filtered_image, folder="filtered"):
-    filtered_image.seek(0)  # Without this line it fails
-    new_url = upload_fileobj_to_s3(
-        filtered_image,
-        random_file_name(),
-        'image/jpeg',
-        config.S3_BUCKET,
-        folder
-    )
-
-    return new_url
+    return [item.key for item in items]
 
 
 def validate_upload(request):
@@ -79,6 +49,39 @@ def validate_upload(request):
     #     raise Exception("Empty file")
 
 
+def validate_batch(request, user_id):
+    """The batch's files, or its keys when it names the user's originals already uploaded."""
+    if request.is_json:
+        keys = (request.get_json(silent=True) or {}).get("keys")
+
+        if not isinstance(keys, list) or not keys:
+            raise Exception("No keys supplied")
+
+        for key in keys:
+            if not allowed_key(key, user_id):
+                raise Exception("Invalid key")
+
+        return [], keys
+
+    files = request.files.getlist("user_file")
+
+    if not files:
+        raise Exception("No user_file key in request.files")
+
+    for file in files:
+        if file.filename == "" or not allowed_file(file):
+            raise Exception("Invalid file type")
+
+    return files, []
+
+
+def allowed_key(key, user_id):
+    return isinstance(key, str) \
+           and key.startswith(original_folder(user_id) + "/") \
+           and ".." not in key \
+           and key.lower().endswith((".jpg", ".png"))
+
+
 def allowed_file(file):
     return file \
            and file.filename.lower().endswith(".jpg") \
@@ -89,16 +92,28 @@ def create_uuid():
     return uuid.uuid4()
 
 
+# (user_id, imid) is unique, and a clash is only found when the finished document is
+# inserted, so imids are long enough (64 bits) that one never happens in practice
+IMID_LENGTH = 16
+
+
+def create_imid():
+    return uuid.uuid4().hex[:IMID_LENGTH]
+
+
+USER_RESPONSE_FIELDS = {'_id': 0, 'original_url': 1, 'filtered': 1}
+
+
+def user_response(img):
+    return {key: img[key] for key in ['original_url', 'filtered']}
+
+
 def get_dominant_colour(api_response):
     colour = api_response['imagePropertiesAnnotation']['dominantColors']['colors'][0]
 
     return colour['color'], colour['score']
 
 
-def upload_colour_sample(dom_colour):
-    return upload_object(colour_sample(dom_colour), "sample/colour")
-
-
 def colour_sample(colour, height=100, width=100):
     blank_image = blank_array(height, width)
 
@@ -108,11 +123,8 @@ def colour_sample(colour, height=100, width=100):
 
 
 def get_img_object(image, mime_type):
-    file_obj = BytesIO()
-
-    image.save(file_obj, mime_type.split('/')[1])
-
-    return file_obj
+    # samples are thumbnail sized flat colour, so they get the thumbnail preset
+    return encode(image, "t", mime_type.split('/')[1])
 
 
 def random_file_name(ext='.jpg'):
@@ -0,0 +1,241 @@
+"""Batches image document inserts into insert_many calls.
+
+Each insert returns a future that resolves to the document's _id once its
+batch has been acknowledged under the configured write concern, or fails
+with that document's own error, so a caller that waits on it knows exactly
+what happened to its document.
+
+There is one writer per process, so only inserts made in the same process
+can share a batch. A prefork Celery worker runs one task per child, and a
+single upload only ever has one document to write; that is written straight
+away. The window is only held open while a caller that has more documents
+on their way (a batch upload's pipeline) says so with ``batching()``.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+from pymongo import WriteConcern
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from app.config import config
+from app.metrics.metrics import registry
+
+DUPLICATE_KEY = 11000
+
+WRITE_BATCH_DOCUMENTS = registry.histogram(
+    "inflex_mongo_write_batch_documents",
+    "Documents in each batched insert.",
+    [], buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+WRITE_FLUSH_SECONDS = registry.histogram(
+    "inflex_mongo_write_flush_seconds",
+    "Time to write one batch, retries included.",
+    ["outcome"])
+
+WRITE_WAIT_SECONDS = registry.histogram(
+    "inflex_mongo_write_wait_seconds",
+    "Time from a document being queued to its write being acknowledged.",
+    [])
+
+Write = namedtuple('Write', ['document', 'future', 'queued'])
+
+
+class DocumentWriteError(Exception):
+
+    def __init__(self, error):
+        self.error = error
+
+        super().__init__("{} (code {})".format(error.get('errmsg'), error.get('code')))
+
+
+def write_concern():
+    w = config.MONGO_WRITE_CONCERN
+
+    return WriteConcern(w=int(w) if w.isdigit() else w, j=config.MONGO_WRITE_JOURNAL,
+                        wtimeout=config.MONGO_WRITE_TIMEOUT_MS or None)
+
+
+class BatchWriter:
+    """Inserts documents into one collection in batches, from a thread of its own.
+
+    ``collection`` only needs ``insert_many``, so a mongomock collection can
+    be passed in place of the real one.
+    """
+
+    def __init__(self, collection=None, batch_size=None, window=None, retries=None, backoff=None):
+        self.collection = collection
+        self.batch_size = batch_size or config.MONGO_WRITE_BATCH_SIZE
+        self.window = config.MONGO_WRITE_WINDOW if window is None else window
+        self.retries = config.MONGO_WRITE_RETRIES if retries is None else retries
+        self.backoff = config.MONGO_WRITE_RETRY_BACKOFF if backoff is None else backoff
+        self.pid = None
+        self.starting = threading.Lock()
+
+    def get_collection(self):
+        if self.collection is None:
+            from app import db
+            self.collection = db.db['inflex_test'].with_options(write_concern=write_concern())
+
+        return self.collection
+
+    def start(self):
+        self.queue = []
+        self.ready = threading.Condition()
+        # callers with more documents on the way, which is what makes waiting for a batch worthwhile
+        self.batching_callers = 0
+
+        thread = threading.Thread(target=self.run, name="mongo-writer", daemon=True)
+        thread.start()
+
+        self.pid = os.getpid()
+
+    def ensure_started(self):
+        # a forked worker inherits the queue but not the thread, so each process starts its own
+        if self.pid != os.getpid():
+            with self.starting:
+                if self.pid != os.getpid():
+                    self.start()
+
+    @contextmanager
+    def batching(self):
+        """Hold each batch open for up to the window while the block runs, for the inserts it makes."""
+        self.ensure_started()
+
+        with self.ready:
+            self.batching_callers += 1
+
+        try:
+            yield
+        finally:
+            with self.ready:
+                self.batching_callers -= 1
+                self.ready.notify()
+
+    def insert(self, document):
+        """Queue a document; the future gets its _id once the write is acknowledged."""
+        self.ensure_started()
+
+        future = Future()
+
+        with self.ready:
+            self.queue.append(Write(document, future, time.perf_counter()))
+            self.ready.notify()
+
+        return future
+
+    def run(self):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+
+                # the first document waits at most one window for others to join it, and only
+                # while someone has more to send; otherwise nothing is coming to join it
+                deadline = self.queue[0].queued + self.window
+
+                while self.batching_callers and len(self.queue) < self.batch_size \
+                        and time.perf_counter() < deadline:
+                    self.ready.wait(deadline - time.perf_counter())
+
+                batch = self.queue[:self.batch_size]
+                del self.queue[:self.batch_size]
+
+            try:
+                self.flush(batch)
+            except Exception as e:
+                # never leave a caller waiting on a future nothing is going to settle
+                for write in batch:
+                    if not write.future.done():
+                        write.future.set_exception(e)
+
+    def flush(self, batch):
+        WRITE_BATCH_DOCUMENTS.observe(len(batch))
+        start = time.perf_counter()
+
+        pending, error = self.write(batch, retried=False)
+
+        for attempt in range(self.retries):
+            if not pending:
+                break
+
+            time.sleep(self.backoff * 2 ** attempt)
+            pending, error = self.write(pending, retried=True)
+
+        for write in pending:
+            write.future.set_exception(error)
+
+        # documents failed outright (a duplicate key, say) are settled without being retried
+        failed = any(write.future.exception() is not None for write in batch)
+        WRITE_FLUSH_SECONDS.observe(time.perf_counter() - start, outcome="error" if failed else "ok")
+
+    def write(self, batch, retried):
+        """Insert the batch once, settling each document's future unless it is worth trying again.
+
+        Returns the writes to try again, and the error that stopped them.
+        """
+        try:
+            # insert_many sets each document's _id before sending, so a retry resends the same ids
+            self.get_collection().insert_many([write.document for write in batch], ordered=False)
+        except AutoReconnect as e:
+            # covers timeouts and a primary stepping down; any of the batch may have been written
+            return batch, e
+        except BulkWriteError as e:
+            return self.settle_bulk_error(batch, e, retried)
+        except Exception as e:
+            for write in batch:
+                write.future.set_exception(e)
+
+            return [], None
+
+        for write in batch:
+            self.acknowledge(write)
+
+        return [], None
+
+    def settle_bulk_error(self, batch, bulk_error, retried):
+        errors = {error['index']: error for error in bulk_error.details.get('writeErrors', [])}
+        # written to the primary but not (yet) with the concern asked for, so worth another go
+        unconfirmed = bool(bulk_error.details.get('writeConcernErrors'))
+        retry = []
+
+        for (index, write) in enumerate(batch):
+            error = errors.get(index)
+
+            if error is None:
+                if unconfirmed:
+                    retry.append(write)
+                else:
+                    self.acknowledge(write)
+            elif retried and self.written_before(write, error):
+                # an earlier attempt wrote it before the error that made us retry
+                self.acknowledge(write)
+            else:
+                write.future.set_exception(DocumentWriteError(error))
+
+        return retry, bulk_error
+
+    def written_before(self, write, error):
+        """Whether a duplicate key error is this very document, already inserted.
+
+        Only a clash on _id with the document's own _id says that; a clash on
+        any other unique index (user_id, imid) is a different document.
+        """
+        if error.get('code') != DUPLICATE_KEY:
+            return False
+
+        if 'keyValue' in error:
+            return error['keyValue'] == {'_id': write.document.get('_id')}
+
+        # servers before 4.2 only name the index in the message
+        return error.get('keyPattern') == {'_id': 1} or ' index: _id_ ' in error.get('errmsg', '')
+
+    def acknowledge(self, write):
+        WRITE_WAIT_SECONDS.observe(time.perf_counter() - write.queued)
+        write.future.set_result(write.document.get('_id'))
+
+
+writer = BatchWriter()
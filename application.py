@@ -1,16 +1,26 @@
-import datetime
+import functools
 
-from flask import Flask, request, jsonify, Response
+from flask import Flask, request, jsonify, Response, redirect
 from flask_api import status
 from flask_mako import MakoTemplates, render_template
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from app import db
-from app.analysis.dominant_colours import analyze
-from app.filters.base_filter import Filterable, BaseFilter
-from app.recommend.recommender import get_recommendation
+from app.cache.render_cache import render_cache, render_key
+from app.config.config import RENDER_CACHE_MAX_AGE, SWATCH_MAX_AGE, BATCH_MAX_IMAGES
+from app.filters.encoding import negotiate, JPEG, MIMETYPES
+from app.filters.render import get_filter, do_filter_from_img_json, get_img_for_response, RENDER_SIZES, \
+    RENDER_FIELDS
+from app.metrics.metrics import registry, timed, note, pixel_class, start_breakdown, finish_breakdown, \
+    configure_logging
 from app.tasks import tasks
-from app.web.util import create_uuid, validate_upload, upload_original, upload_object
+from app.web.pagination import page_params, stream_docs, InvalidPage
+from app.web.renditions import stored_rendition, store_rendition, filter_entry, is_current
+from app.web.swatches import SWATCH_NAME, swatch_image
+from app.web.uploader import UploadError
+from app.web.util import create_uuid, create_imid, validate_upload, validate_batch, upload_originals, \
+    user_response, USER_RESPONSE_FIELDS
 
 SIZES = ['full', 'preview', 'thumb']
 
@@ -22,6 +32,34 @@ STATIC = 'static'
 
 application.config.from_object("app.config.config")
 
+configure_logging()
+
+
+@application.before_request
+def start_request_breakdown():
+    start_breakdown(method=request.method, path=request.path)
+
+
+@application.after_request
+def note_response_status(response):
+    note(status=response.status_code)
+
+    return response
+
+
+@application.teardown_request
+def log_request_breakdown(error=None):
+    # teardown runs even when a view raises, which after_request does not
+    if error is None:
+        finish_breakdown()
+    else:
+        finish_breakdown(status=status.HTTP_500_INTERNAL_SERVER_ERROR, error=repr(error))
+
+
+@application.route('/metrics', methods=["GET"])
+def metrics():
+    return Response(registry.expose(), mimetype='text/plain; version=0.0.4')
+
 
 def format_response(response):
     response.pop('_id')
@@ -41,116 +79,174 @@ def get_history(user_id):
     if not db.user_exists(user_id):
         return jsonify(_uuid=request_uid, error="Invalid user"), status.HTTP_404_NOT_FOUND
 
-    all = db.get_all_by_user(user_id)
-
-    posts = []
+    try:
+        after, limit, fields = page_params(request.args)
+    except InvalidPage as e:
+        return jsonify(_uuid=request_uid, error=str(e)), status.HTTP_400_BAD_REQUEST
 
-    for post in all:
-        post['_id'] = str(post['_id'])
-        posts.append(post)
+    query = functools.partial(db.get_all_by_user, user_id)
 
-    return jsonify(posts)
+    return Response(stream_docs(query, after, limit, fields), mimetype='application/json')
 
 
 @application.route('/users/<string:user_id>/images', methods=["POST"])
 def upload(user_id):
     request_uid = create_uuid()
-    print(str(request_uid))
+    note(_uuid=str(request_uid))
 
     if not db.user_exists(user_id):
         return jsonify(_uuid=request_uid, error="Invalid user"), status.HTTP_404_NOT_FOUND
 
     try:
         validate_upload(request)
+    except RequestEntityTooLarge:
+        raise
     except Exception:
         return jsonify(_uuid=request_uid, error="Invalid file"), status.HTTP_400_BAD_REQUEST
 
-    original_uploaded_url = upload_original(request.files["user_file"])
+    # streamed to S3 here, so the job carries the original's key rather than the image itself
+    try:
+        key = upload_originals(user_id, [request.files["user_file"]])[0]
+    except UploadError:
+        return jsonify(_uuid=request_uid, error="Upload failed"), status.HTTP_502_BAD_GATEWAY
+
+    imid = create_imid()
+    job_id = tasks.upload_job_id(user_id, imid)
+
+    db.create_job(job_id, user_id)
+
+    job = tasks.process_upload.apply_async(args=(imid, key, str(request_uid), user_id), task_id=job_id)
 
-    imid = create_uuid().hex[:5]
+    return jsonify(_uuid=request_uid,
+                   job_id=job.id,
+                   im_url="http://localhost:8080/users/" + user_id + "/images/" + imid,
+                   status_url="http://localhost:8080/users/" + user_id + "/images/" + imid + "/status"), \
+        status.HTTP_202_ACCEPTED
 
-    do_filter(imid, original_uploaded_url, request_uid, user_id)
 
-    return jsonify(im_url="http://localhost:8080/users/" + user_id + "/images/" + imid)
+@application.route('/users/<string:user_id>/images/batch', methods=["POST"])
+def upload_batch(user_id):
+    request_uid = create_uuid()
+    note(_uuid=str(request_uid))
 
+    if not db.user_exists(user_id):
+        return jsonify(_uuid=request_uid, error="Invalid user"), status.HTTP_404_NOT_FOUND
 
-def do_filter(imid, original_uploaded_url, request_uid, user_id):
-    # api_response = google_vision_api(original_uploaded_url, application.config["VISION_API"])
-    # dom_colour, dom_score = get_dominant_colour(api_response)
-    image = Filterable.from_url(original_uploaded_url)
-    vibrant, dominant = analyze(image)
-    filtered_images = filter_all(image)
-    response = {
-        'original_url': original_uploaded_url,
-        'filtered': {
-            'recommended': get_recommendation(),
-            'all': filtered_images
-        },
-        'properties': {
-            'vibrant_colour': vibrant,
-            'dominant_colours': dominant
-        },
-        'user_id': user_id,
-        'timestamp': datetime.datetime.now().timestamp(),
-        '_uuid': str(request_uid),
-        'imid': imid
-    }
+    try:
+        files, keys = validate_batch(request, user_id)
+    except RequestEntityTooLarge:
+        raise
+    except Exception:
+        return jsonify(_uuid=request_uid, error="Invalid batch"), status.HTTP_400_BAD_REQUEST
 
-    tasks.insert.delay(response)
+    if len(files) + len(keys) > BATCH_MAX_IMAGES:
+        return jsonify(_uuid=request_uid, error="At most {} images per batch".format(BATCH_MAX_IMAGES)), \
+            status.HTTP_400_BAD_REQUEST
 
+    # the originals go to S3 here, so the job carries keys rather than the images themselves
+    try:
+        keys += upload_originals(user_id, files)
+    except UploadError:
+        return jsonify(_uuid=request_uid, error="Upload failed"), status.HTTP_502_BAD_GATEWAY
 
-def filter_all(image):
-    filters = BaseFilter.__subclasses__()
-    filtered_images = []
+    images = [{'imid': create_imid(), 'key': key} for key in keys]
 
-    for current_filter in filters:
-        filtered_image = current_filter.apply(image)
-        filtered_images.append({
-            'id': current_filter.id(),
-            'name': current_filter.name(),
-            'thumb_url': upload_object(filtered_image.square_thumb_bytes()),
-            'preview_url': upload_object(filtered_image.preview_bytes())
-        })
+    batch_id = create_uuid().hex[:8]
+    job_id = tasks.batch_job_id(user_id, batch_id)
 
-    return filtered_images
+    db.create_job(job_id, user_id)
 
+    job = tasks.process_batch.apply_async(
+        args=(batch_id, images, str(request_uid), user_id),
+        task_id=job_id)
 
-@application.route('/users/<string:user_id>/images/<string:image_id>', methods=["GET"])
-def get_image(user_id, image_id):
+    status_url = "http://localhost:8080/users/" + user_id + "/batches/" + batch_id + "/status"
+
+    return jsonify(_uuid=request_uid,
+                   batch_id=batch_id,
+                   job_id=job.id,
+                   status_url=status_url,
+                   images=[{'imid': image['imid'],
+                            'key': image['key'],
+                            'im_url': "http://localhost:8080/users/" + user_id + "/images/" + image['imid']}
+                           for image in images]), \
+        status.HTTP_202_ACCEPTED
+
+
+@application.route('/users/<string:user_id>/batches/<string:batch_id>/status', methods=["GET"])
+def get_batch_status(user_id, batch_id):
     request_uid = create_uuid()
 
-    if not db.user_exists(user_id) \
-            or not db.image_exists(user_id, image_id):
-        return jsonify(_uuid=request_uid, error="Invalid"), status.HTTP_404_NOT_FOUND
+    if not db.user_exists(user_id):
+        return jsonify(_uuid=request_uid, error="Invalid user"), status.HTTP_404_NOT_FOUND
+
+    job_id = tasks.batch_job_id(user_id, batch_id)
+    job = db.get_job(job_id)
 
-    imgs = get_img_from_db(user_id, image_id)
+    if job is None:
+        return jsonify(_uuid=request_uid, error="Invalid batch"), status.HTTP_404_NOT_FOUND
 
-    return jsonify(user_response(imgs))
+    if job['state'] == tasks.FAILURE:
+        return jsonify(_uuid=request_uid, job_id=job_id, status=job['state'], error="Processing failed")
 
+    if job['state'] == tasks.SUCCESS:
+        images = job['images']
+    elif job['state'] == tasks.PROGRESS:
+        images = [{'imid': imid, 'status': state} for (imid, state) in sorted(job['images'].items())]
+    else:
+        images = None
 
-def get_img_from_db(user_id, image_id):
-    db_image = db.get_image(user_id, image_id)
-    images = []
-    for image in db_image:
-        image['_id'] = str(image['_id'])
-        images.append(image)
+    return jsonify(_uuid=request_uid, job_id=job_id, status=job['state'], images=images)
 
-    return images
+
+@application.route('/users/<string:user_id>/images/<string:image_id>/status', methods=["GET"])
+def get_upload_status(user_id, image_id):
+    request_uid = create_uuid()
+
+    if not db.user_exists(user_id):
+        return jsonify(_uuid=request_uid, error="Invalid user"), status.HTTP_404_NOT_FOUND
+
+    job_id = tasks.upload_job_id(user_id, image_id)
+
+    if db.image_exists(user_id, image_id):
+        return jsonify(_uuid=request_uid, job_id=job_id, status=tasks.SUCCESS)
+
+    job = db.get_job(job_id)
+
+    if job is None:
+        return jsonify(_uuid=request_uid, error="Invalid image"), status.HTTP_404_NOT_FOUND
+
+    if job['state'] == tasks.FAILURE:
+        return jsonify(_uuid=request_uid, job_id=job_id, status=job['state'], error="Processing failed")
+
+    return jsonify(_uuid=request_uid, job_id=job_id, status=job['state'], progress=job.get('progress'))
+
+
+@application.route('/users/<string:user_id>/images/<string:image_id>', methods=["GET"])
+def get_image(user_id, image_id):
+    request_uid = create_uuid()
+
+    # an image can only have been stored for an existing user, so one lookup covers both checks
+    img = db.get_image_for_user(user_id, image_id, USER_RESPONSE_FIELDS)
+
+    if img is None:
+        return jsonify(_uuid=request_uid, error="Invalid"), status.HTTP_404_NOT_FOUND
+
+    return jsonify(user_response(img))
 
 
 @application.route('/users/<string:user_id>/images/<string:image_id>/<string:filter_id>')
 def get_image_filter(user_id, image_id, filter_id):
     request_uid = create_uuid()
 
-    if not db.user_exists(user_id) \
-            or not db.image_exists(user_id, image_id):
-        return jsonify(_uuid=request_uid, error="Invalid"), status.HTTP_404_NOT_FOUND
+    img = db.get_image_for_user(user_id, image_id, {'_id': 0, 'filtered.all': 1})
 
-    imgs = get_img_from_db(user_id, image_id)
+    if img is None:
+        return jsonify(_uuid=request_uid, error="Invalid"), status.HTTP_404_NOT_FOUND
 
-    for filt in imgs[0]['filtered']['all']:
+    for filt in img['filtered']['all']:
         if filt['id'] == filter_id:
-            return filt
+            return jsonify(filt)
 
     return jsonify(_uuid=request_uid, error="Invalid filter"), status.HTTP_404_NOT_FOUND
 
@@ -158,68 +254,95 @@ def get_image_filter(user_id, image_id, filter_id):
 @application.route('/users/<string:user_id>/images/<string:image_id>_<string:filter_id>_<string:size>.jpg')
 def get_image_filter_full(user_id, image_id, filter_id, size):
     request_uid = create_uuid()
+    note(_uuid=str(request_uid), filter=filter_id, size=size)
+
+    img_json = db.get_image_for_user(user_id, image_id, RENDER_FIELDS)
 
-    if not db.user_exists(user_id) \
-            or not db.image_exists(user_id, image_id):
+    if img_json is None:
         return jsonify(_uuid=request_uid, error="Invalid"), status.HTTP_404_NOT_FOUND
 
-    img_json = get_img_from_db(user_id, image_id)
     filter_obj = get_filter(filter_id)
-    if filter_obj is not None and len(img_json) > 0:
-        filtered = do_filter_from_img_json(filter_obj, img_json[0])
+    if filter_obj is not None and size in RENDER_SIZES:
+        # the url says .jpg, but clients that ask for webp by name get webp
+        output_format = negotiate(request.accept_mimetypes)
+
+        stored = stored_rendition(img_json, filter_obj, size, output_format)
+        if stored is not None:
+            return stored_response(stored['url'])
+
+        etag = render_key(img_json, filter_obj, size, output_format)
+
+        if etag in request.if_none_match:
+            return not_modified_response(etag)
+
+        img = render_cache.get(etag)
+        if img is None:
+            filtered = do_filter_from_img_json(filter_obj, img_json, size)
+            with timed("encode", filter=filter_id, pixels=pixel_class(filtered.pillow.size)):
+                img = get_img_for_response(filtered, size, output_format).getvalue()
+            render_cache.put(etag, img)
 
-        img = get_img_for_response(filtered, size)
-        if img is not None:
-            return image_response(img)
+            entry = filter_entry(img_json, filter_id)
+            if entry is not None and is_current(entry, filter_obj):
+                store_rendition(user_id, image_id, filter_obj, size, img, output_format)
+
+        return image_response(img, etag, output_format)
 
     return jsonify(_uuid=request_uid, error="Invalid filter"), status.HTTP_404_NOT_FOUND
 
 
-def get_img_for_response(filtered, size):
-    if size == "f":
-        return filtered.as_bytes()
-    if size == "p":
-        return filtered.preview_bytes()
-    if size == "t":
-        return filtered.thumb_bytes()
+def stored_response(url):
+    response = redirect(url, code=status.HTTP_302_FOUND)
+    response.cache_control.public = True
+    response.cache_control.max_age = RENDER_CACHE_MAX_AGE
+    response.vary.add('Accept')
+
+    return response
+
 
-    return None
+def image_response(image, etag, output_format=JPEG):
+    response = Response(image, mimetype=MIMETYPES[output_format])
 
+    return cacheable(response, etag)
 
-def image_response(image):
-    return Response(image.getvalue(), mimetype='image/jpeg')
 
+def not_modified_response(etag):
+    return cacheable(Response(status=status.HTTP_304_NOT_MODIFIED), etag)
 
-def do_filter_from_img_json(filter_class, img_json):
-    image = Filterable.from_url(img_json['original_url'])
-    filtered = filter_class.apply(image)
-    return filtered
 
+def cacheable(response, etag):
+    # the url stays the same when a filter changes version, so clients revalidate with the etag
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = RENDER_CACHE_MAX_AGE
+    response.vary.add('Accept')
 
-def get_filter(filter_id):
-    filters = BaseFilter.__subclasses__()
+    return response
 
-    for filter_class in filters:
-        if filter_class.id() == filter_id:
-            return filter_class
 
-    return None
+@application.route('/swatches/<string:name>.jpg', methods=["GET"])
+def get_swatch(name):
+    if not SWATCH_NAME.match(name):
+        return jsonify(_uuid=create_uuid(), error="Invalid colour"), status.HTTP_404_NOT_FOUND
 
+    # a swatch never changes, so it can be cached for as long as clients like
+    response = Response(swatch_image(name).getvalue(), mimetype='image/jpeg')
+    response.cache_control.public = True
+    response.cache_control.max_age = SWATCH_MAX_AGE
 
-def user_response(imgs):
-    return {key: imgs[0][key] for key in ['original_url', 'filtered']}
+    return response
 
 
 @application.route('/show', methods=["GET"])
 def show_db():
-    all = db.get_all()
-    posts = []
+    request_uid = create_uuid()
 
-    for post in all:
-        post['_id'] = str(post['_id'])
-        posts.append(post)
+    try:
+        after, limit, fields = page_params(request.args)
+    except InvalidPage as e:
+        return jsonify(_uuid=request_uid, error=str(e)), status.HTTP_400_BAD_REQUEST
 
-    return jsonify(posts)
+    return Response(stream_docs(db.get_all, after, limit, fields), mimetype='application/json')
 
 
 @application.route('/users/', methods=["POST"])
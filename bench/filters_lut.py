@@ -0,0 +1,105 @@
+"""Compare the lookup table filters against the original float64 pipeline.
+
+    python -m bench.filters_lut [megapixels ...]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy
+import skimage
+
+from app.filters.base_filter import Filterable, Gotham, Bridge, Brighter, float_to_uint8, split_channels, \
+    merge_channels, channel_adjust, increase_channel, decrease_channel, blue_channel, BOOST_LOWER, GOTHAM_ADJUST
+
+
+# the filters' curves as they were written before they were declared as ops
+def gotham_curves(array):
+    r, g, b = split_channels(array)
+
+    final = merge_channels(
+        channel_adjust(r, BOOST_LOWER),
+        g,
+        increase_channel(b, 0.03))
+
+    final[:, :, 2] = channel_adjust(blue_channel(final), GOTHAM_ADJUST)
+
+    return final
+
+
+def bridge_curves(array):
+    r, g, b = split_channels(array)
+
+    r_lower = channel_adjust(r, BOOST_LOWER)
+
+    return merge_channels(
+        channel_adjust(r_lower, GOTHAM_ADJUST),
+        decrease_channel(g, 0.03),
+        b)
+
+
+def brighter_curves(array):
+    r, g, b = split_channels(array)
+
+    return merge_channels(
+        increase_channel(r, 0.2),
+        increase_channel(g, 0.2),
+        increase_channel(b, 0.2))
+
+
+LEGACY_CURVES = {Gotham: gotham_curves, Bridge: bridge_curves, Brighter: brighter_curves}
+
+
+def legacy_apply(filter_class, filterable):
+    from bench.sharpen import legacy_sharpen
+
+    final = LEGACY_CURVES[filter_class](skimage.img_as_float(filterable.as_array()))
+
+    if filter_class is Bridge:
+        final = legacy_sharpen(final, filterable.scale)
+
+    return Filterable.from_array(float_to_uint8(final))
+
+
+def sample_image(megapixels, seed=0):
+    height = int((megapixels * 1e6 * 3 / 4) ** 0.5)
+    width = int(height * 4 / 3)
+
+    rows = numpy.linspace(0, 200, height).reshape(height, 1, 1)
+    cols = numpy.linspace(0, 55, width).reshape(1, width, 1)
+    noise = numpy.random.RandomState(seed).randint(0, 40, (height, width, 3))
+
+    return Filterable.from_array((rows + cols + noise).clip(0, 255).astype(numpy.uint8))
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return result, elapsed, peak
+
+
+def run(megapixels):
+    image = sample_image(megapixels)
+    image.pillow.load()
+
+    for filter_class in [Gotham, Bridge, Brighter]:
+        legacy, legacy_time, legacy_peak = measure(legacy_apply, filter_class, image)
+        fused, fused_time, fused_peak = measure(filter_class.apply, image)
+
+        diff = numpy.abs(legacy.as_array().astype(int) - fused.as_array().astype(int)).max()
+
+        print("{:>4}MP {:<10} legacy {:7.3f}s {:8.1f}MB  lut {:7.3f}s {:8.1f}MB  max diff {}".format(
+            megapixels, filter_class.id(),
+            legacy_time, legacy_peak / 1e6,
+            fused_time, fused_peak / 1e6,
+            diff))
+
+
+if __name__ == '__main__':
+    for size in [float(arg) for arg in sys.argv[1:]] or [1, 12]:
+        run(size)
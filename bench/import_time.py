@@ -0,0 +1,59 @@
+"""Import-time regression check for the web process.
+
+    python -m bench.import_time [budget_ms]
+
+Imports ``application`` under ``python -X importtime`` in a fresh
+interpreter, prints the slowest top-level imports, and exits non-zero if
+any worker-only module was loaded or the total exceeds the budget.
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# only the celery worker and the Bridge filter should ever load these
+WORKER_ONLY = ['matplotlib', 'sklearn', 'cv2', 'skimage', 'scipy', 'app.analysis']
+
+DEFAULT_BUDGET_MS = 1500
+
+PROBE = "import sys, application; print('\\n'.join(sys.modules))"
+
+
+def import_times():
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=ROOT, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # nesting is shown as two spaces of indentation per level
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        times.append((int(cumulative), depth, name.strip()))
+
+    return times, result.stdout.split()
+
+
+def main(budget_ms):
+    times, modules = import_times()
+    total_ms = sum(us for (us, depth, _) in times if depth == 0) / 1000.0
+
+    # the direct imports are where a new heavy dependency shows up first
+    for (us, _, name) in sorted(entry for entry in times if entry[1] <= 1)[::-1][:15]:
+        print("{:10.1f}ms  {}".format(us / 1000.0, name))
+    print("{:10.1f}ms  total (budget {}ms)".format(total_ms, budget_ms))
+
+    loaded = sorted({name for name in modules for heavy in WORKER_ONLY
+                     if name == heavy or name.startswith(heavy + ".")})
+    if loaded:
+        print("worker-only modules imported by the web process: {}".format(", ".join(loaded)))
+
+    return 1 if loaded or total_ms > budget_ms else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_BUDGET_MS))
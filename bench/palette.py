@@ -0,0 +1,96 @@
+"""Compare extract_palette against the sklearn KMeans it replaced.
+
+    python -m bench.palette [images]
+
+Reports time per image for both, and how far apart the palettes are: the
+mean distance (in RGB units, weighted by cluster share) from each KMeans
+colour to the nearest extracted colour, and the distance between the two
+most vibrant colours.
+"""
+import sys
+import time
+
+import numpy
+from sklearn.cluster import KMeans
+
+from app.analysis.dominant_colours import sort_by_vibrance, rgb_to_hsv
+from app.analysis.palette import extract_palette
+
+
+def sample_pixels(seed):
+    # a 100x100 thumbnail made of a few noisy colour regions
+    random = numpy.random.RandomState(seed)
+    image = numpy.empty((100, 100, 3))
+    bounds = numpy.sort(random.randint(1, 100, random.randint(2, 7)))
+
+    for (start, end) in zip(numpy.concatenate([[0], bounds]), numpy.concatenate([bounds, [100]])):
+        image[start:end] = random.randint(0, 256, 3)
+
+    image += random.normal(0, 12, image.shape)
+
+    return image.clip(0, 255).astype(numpy.uint8).reshape(-1, 3)
+
+
+def centroid_histogram(kmeans):
+    # grab the number of different clusters and create a histogram
+    # based on the number of pixels assigned to each cluster
+    numLabels = numpy.arange(0, len(numpy.unique(kmeans.labels_)) + 1)
+    (hist, _) = numpy.histogram(kmeans.labels_, bins=numLabels)
+
+    # normalize the histogram, such that it sums to one
+    hist = hist.astype("float")
+    hist /= hist.sum()
+
+    # return the histogram
+    return hist
+
+
+def kmeans_palette(pixels):
+    kmeans = KMeans(n_clusters=5).fit(pixels)
+
+    return centroid_histogram(kmeans), kmeans.cluster_centers_
+
+
+def most_vibrant(colours):
+    return sort_by_vibrance(rgb_to_hsv(colours / 255.0))[0]
+
+
+def palette_distance(reference, candidate):
+    ref_hist, ref_colours = reference
+    _, colours = candidate
+
+    nearest = numpy.sqrt(((ref_colours[:, None, :] - colours[None, :, :]) ** 2).sum(axis=2)).min(axis=1)
+
+    return (nearest * ref_hist).sum()
+
+
+def timed(fn, pixels):
+    start = time.perf_counter()
+    result = fn(pixels)
+
+    return result, time.perf_counter() - start
+
+
+def run(images):
+    kmeans_times, palette_times, distances, vibrant = [], [], [], []
+
+    for seed in range(images):
+        pixels = sample_pixels(seed)
+
+        reference, kmeans_time = timed(kmeans_palette, pixels)
+        candidate, palette_time = timed(extract_palette, pixels)
+
+        kmeans_times.append(kmeans_time)
+        palette_times.append(palette_time)
+        distances.append(palette_distance(reference, candidate))
+        vibrant.append(numpy.abs(most_vibrant(reference[1]) - most_vibrant(candidate[1])).max())
+
+    print("images            {}".format(images))
+    print("kmeans            {:.2f}ms/image".format(1000 * numpy.mean(kmeans_times)))
+    print("extract_palette   {:.2f}ms/image".format(1000 * numpy.mean(palette_times)))
+    print("palette distance  mean {:.2f}  max {:.2f} (rgb units)".format(numpy.mean(distances), numpy.max(distances)))
+    print("vibrant hsv diff  mean {:.3f}  max {:.3f}".format(numpy.mean(vibrant), numpy.max(vibrant)))
+
+
+if __name__ == '__main__':
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 50)
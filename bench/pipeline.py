@@ -0,0 +1,277 @@
+"""Baseline benchmark for the filters, analysis and the upload pipeline.
+
+    python -m bench.pipeline [--megapixels 1 12 24] [--repeat 3] [--only filter.] [--output run.json]
+    python -m bench.pipeline --compare baseline.json run.json
+
+Every stage runs in its own forked process against a generated image, so
+peak RSS is per stage rather than the high-water mark of the whole run.
+Timings are taken without tracing; allocations come from one extra run
+under tracemalloc, which sees Python and numpy buffers but not Pillow's
+own image memory (that shows up in RSS). S3 and Mongo are replaced by in-memory fakes, so the
+end-to-end do_filter numbers are CPU and memory only.
+
+Results are printed (or written) as JSON, one record per stage and size.
+"""
+import argparse
+import datetime
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy
+import PIL
+
+from bench.filters_lut import sample_image
+
+DEFAULT_MEGAPIXELS = [1, 12, 24]
+
+
+class FakeS3:
+    """Stands in for the boto3 client: reads the upload and keeps its size."""
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_fileobj(self, fileobj, bucket, key, ExtraArgs=None):
+        self.objects[key] = len(fileobj.read())
+
+
+class FakeCollection:
+
+    def __init__(self):
+        self.documents = []
+
+    def insert_one(self, document):
+        self.documents.append(document)
+
+    def insert_many(self, documents, ordered=True):
+        self.documents.extend(documents)
+
+    def with_options(self, **options):
+        return self
+
+    def find_one(self, query):
+        return None
+
+    def update_one(self, query, update, upsert=False):
+        self.documents.append(update)
+
+
+class FakeDatabase(dict):
+
+    def __missing__(self, name):
+        collection = self[name] = FakeCollection()
+        return collection
+
+
+def install_fakes():
+    from app import db
+    from app.web.uploader import uploader
+
+    uploader.client = FakeS3()
+    db.db = FakeDatabase()
+
+
+def jpeg_bytes(filterable):
+    output = BytesIO()
+    filterable.pillow.save(output, "jpeg", quality=90)
+
+    return output.getvalue()
+
+
+def call(method):
+    return lambda image: lambda image: getattr(image, method)()
+
+
+def do_filter_stage(image):
+    from app.tasks.tasks import do_filter
+
+    original = jpeg_bytes(image)
+
+    return lambda _: do_filter("bench", "bench.jpg", original, "bench", "bench")
+
+
+def stages():
+    """(name, setup) pairs; setup takes the loaded image and returns the call to time."""
+    from app.analysis.dominant_colours import analyze
+    from app.filters.registry import filter_registry
+
+    found = [("filter." + filter_class.id(), lambda image, f=filter_class: f.apply)
+             for filter_class in filter_registry.all()]
+
+    return found + [
+        ("filterable.thumbnail", call("thumbnail")),
+        ("filterable.preview", call("preview")),
+        ("filterable.square_thumb", call("square_thumb")),
+        ("filterable.encode", call("as_bytes")),
+        ("analyze", lambda image: analyze),
+        ("do_filter", do_filter_stage),
+    ]
+
+
+def reset_peak_rss():
+    # a forked child starts with its parent's high-water mark; linux can reset it
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    # kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def measure(name, setup, megapixels, repeat):
+    install_fakes()
+
+    image = sample_image(megapixels)
+    image.pillow.load()
+    fn = setup(image)
+    reset_peak_rss()
+    rss_before = peak_rss()
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(image)
+        times.append(time.perf_counter() - start)
+
+    rss_peak = peak_rss()
+
+    tracemalloc.start()
+    fn(image)
+    current, traced_peak = tracemalloc.get_traced_memory()
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+
+    return {
+        'stage': name,
+        'megapixels': megapixels,
+        'size': list(image.pillow.size),
+        'repeat': repeat,
+        'seconds': {
+            'min': min(times),
+            'median': statistics.median(times),
+            'max': max(times)
+        },
+        'rss': {
+            'before_bytes': rss_before,
+            'peak_bytes': rss_peak,
+            'stage_bytes': rss_peak - rss_before
+        },
+        'allocations': {
+            'peak_bytes': traced_peak,
+            'retained_bytes': current,
+            'retained_blocks': blocks
+        }
+    }
+
+
+def run_isolated(queue, name, setup, megapixels, repeat):
+    try:
+        queue.put(measure(name, setup, megapixels, repeat))
+    except Exception as e:
+        queue.put({'stage': name, 'megapixels': megapixels, 'error': repr(e)})
+
+
+def run(megapixels, repeat, only=None):
+    context = multiprocessing.get_context("fork")
+    results = []
+
+    for size in megapixels:
+        for (name, setup) in stages():
+            if only and not any(name.startswith(prefix) for prefix in only):
+                continue
+
+            queue = context.Queue()
+            process = context.Process(target=run_isolated, args=(queue, name, setup, size, repeat))
+            process.start()
+            result = queue.get()
+            process.join()
+
+            print("{:>4}MP {:<24} {}".format(size, name, describe(result)), file=sys.stderr)
+            results.append(result)
+
+    return {
+        'started': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'pillow': PIL.__version__,
+        'cpus': multiprocessing.cpu_count(),
+        'results': results
+    }
+
+
+def describe(result):
+    if 'error' in result:
+        return "failed: " + result['error']
+
+    return "{:8.3f}s  rss +{:7.1f}MB  allocated {:7.1f}MB".format(
+        result['seconds']['median'],
+        result['rss']['stage_bytes'] / 1e6,
+        result['allocations']['peak_bytes'] / 1e6)
+
+
+def compare(baseline_path, run_path):
+    with open(baseline_path) as f:
+        baseline = {(r['stage'], r['megapixels']): r for r in json.load(f)['results'] if 'error' not in r}
+
+    with open(run_path) as f:
+        current = [r for r in json.load(f)['results'] if 'error' not in r]
+
+    for result in current:
+        before = baseline.get((result['stage'], result['megapixels']))
+        if before is None:
+            continue
+
+        print("{:>4}MP {:<24} time x{:5.2f}  rss x{:5.2f}  allocated x{:5.2f}".format(
+            result['megapixels'], result['stage'],
+            result['seconds']['median'] / before['seconds']['median'],
+            ratio(result['rss']['peak_bytes'], before['rss']['peak_bytes']),
+            ratio(result['allocations']['peak_bytes'], before['allocations']['peak_bytes'])))
+
+
+def ratio(new, old):
+    return new / old if old else float('nan')
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the filters, analysis and upload pipeline.")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=DEFAULT_MEGAPIXELS)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--only", nargs="+", help="stage name prefixes to run, e.g. filter. do_filter")
+    parser.add_argument("--output", help="write the JSON here instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RUN"))
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = json.dumps(run(args.megapixels, args.repeat, args.only), indent=2)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,65 @@
+"""Compare the downsampled blur in sharpen against the full-resolution skimage gaussian.
+
+    python -m bench.sharpen [megapixels ...]
+
+The stated tolerance is at most 1 level (of 255) per channel in Bridge's
+final uint8 output; the run exits non-zero if any size exceeds it. It also
+checks that strip mode still gives output identical to the full-image path.
+"""
+import sys
+import time
+
+import numpy
+import skimage
+from skimage import filters
+
+from app.filters.base_filter import Bridge, float_to_uint8, curves_sharpen, strip_curves_sharpen
+from app.filters.compiler import point_lut
+from bench.filters_lut import sample_image, bridge_curves
+
+TOLERANCE = 1
+
+
+def legacy_sharpen(array, scale=1.0):
+    blurred = filters.gaussian(array, sigma=10 * scale, multichannel=True)
+
+    return numpy.clip(array * 1.3 - blurred * 0.3, 0, 1.0)
+
+
+def legacy_bridge(filterable):
+    final = legacy_sharpen(bridge_curves(skimage.img_as_float(filterable.as_array())), filterable.scale)
+
+    return float_to_uint8(final)
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+
+    return result, time.perf_counter() - start
+
+
+def run(megapixels):
+    image = sample_image(megapixels)
+    image.pillow.load()
+
+    # Bridge's point ops, without its blur-sharpen
+    lut = point_lut(Bridge.ops[:-1], numpy.float32)
+    array = image.as_array()
+
+    legacy, legacy_time = timed(legacy_bridge, image)
+    fast, fast_time = timed(curves_sharpen, array, lut, image.scale)
+    strip = strip_curves_sharpen(array, lut, image.scale, rows=256)
+
+    diff = numpy.abs(legacy.astype(int) - fast.astype(int))
+
+    print("{:>5}MP  gaussian {:7.3f}s  fast {:7.3f}s  x{:5.1f}  max diff {}  mean diff {:.4f}  strips identical {}".format(
+        megapixels, legacy_time, fast_time, legacy_time / fast_time, diff.max(), diff.mean(),
+        numpy.array_equal(fast, strip)))
+
+    return diff.max() <= TOLERANCE and numpy.array_equal(fast, strip)
+
+
+if __name__ == '__main__':
+    results = [run(size) for size in [float(arg) for arg in sys.argv[1:]] or [1, 4, 12, 24]]
+    sys.exit(0 if all(results) else 1)
@@ -0,0 +1,146 @@
+import threading
+import time
+import unittest
+
+import mongomock
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from app.writer import BatchWriter, DocumentWriteError, WRITE_FLUSH_SECONDS
+
+
+class ServerErrors:
+    """A mongomock collection whose duplicate key errors carry keyValue, as servers since 4.2 send."""
+
+    def __init__(self, collection, drop_first=False, written_then_dropped=False):
+        self.collection = collection
+        # the first insert_many fails with AutoReconnect, before or after writing its documents
+        self.drop_first = drop_first or written_then_dropped
+        self.written_then_dropped = written_then_dropped
+        self.batches = []
+
+    def insert_many(self, documents, ordered=True):
+        self.batches.append(len(documents))
+
+        if self.drop_first:
+            self.drop_first = False
+
+            if self.written_then_dropped:
+                self.collection.insert_many(documents, ordered=ordered)
+
+            raise AutoReconnect("connection dropped")
+
+        try:
+            return self.collection.insert_many(documents, ordered=ordered)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                document = error['op']
+                stored = self.collection.find_one({'_id': document['_id']})
+
+                if stored is not None and stored['k'] == document['k']:
+                    error['keyValue'] = {'_id': document['_id']}
+                else:
+                    error['keyValue'] = {'k': document['k']}
+
+            raise
+
+
+def flushes(outcome):
+    return WRITE_FLUSH_SECONDS.series.get((outcome,), (None, [0.0, 0]))[1][1]
+
+
+class BatchWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = mongomock.MongoClient().db.images
+        self.collection.create_index('k', unique=True)
+
+    def writer(self, collection, window=0.0):
+        return BatchWriter(collection, batch_size=10, window=window, retries=2, backoff=0.001)
+
+    def test_acknowledges_each_document_with_its_id(self):
+        writer = self.writer(self.collection)
+
+        futures = [writer.insert({'k': i}) for i in range(25)]
+
+        ids = [future.result(timeout=5) for future in futures]
+        self.assertEqual(len(set(ids)), 25)
+        self.assertEqual(len(list(self.collection.find())), 25)
+
+    def test_duplicate_on_another_index_fails_only_that_document(self):
+        self.collection.insert_one({'k': 1})
+        writer = self.writer(self.collection)
+        errors_before = flushes("error")
+
+        with writer.batching():
+            duplicate = writer.insert({'k': 1})
+            other = writer.insert({'k': 2})
+
+        self.assertIsInstance(duplicate.exception(timeout=5), DocumentWriteError)
+        self.assertIsNotNone(other.result(timeout=5))
+        self.assertEqual(flushes("error"), errors_before + 1)
+
+    def test_retried_duplicate_on_own_id_counts_as_written(self):
+        collection = ServerErrors(self.collection, written_then_dropped=True)
+        writer = self.writer(collection)
+
+        futures = [writer.insert({'k': i}) for i in range(3)]
+
+        self.assertEqual([future.exception(timeout=5) for future in futures], [None] * 3)
+        self.assertEqual(len(list(self.collection.find())), 3)
+        self.assertGreater(len(collection.batches), 1)
+
+    def test_retried_duplicate_on_another_index_fails(self):
+        self.collection.insert_one({'k': 1})
+        writer = self.writer(ServerErrors(self.collection, drop_first=True))
+
+        with writer.batching():
+            duplicate = writer.insert({'k': 1})
+            other = writer.insert({'k': 2})
+
+        self.assertIsInstance(duplicate.exception(timeout=5), DocumentWriteError)
+        self.assertIsNotNone(other.result(timeout=5))
+
+    def test_gives_up_after_retries(self):
+        class Down:
+            def insert_many(self, documents, ordered=True):
+                raise AutoReconnect("down")
+
+        writer = self.writer(Down())
+
+        self.assertIsInstance(writer.insert({'k': 1}).exception(timeout=5), AutoReconnect)
+
+    def test_lone_document_does_not_wait_for_the_window(self):
+        collection = ServerErrors(self.collection)
+        writer = self.writer(collection, window=1.0)
+
+        start = time.perf_counter()
+        writer.insert({'k': 1}).result(timeout=5)
+
+        self.assertLess(time.perf_counter() - start, 0.5)
+        self.assertEqual(collection.batches, [1])
+
+    def test_batching_holds_the_window_open_for_other_inserts(self):
+        collection = ServerErrors(self.collection)
+        writer = self.writer(collection, window=0.2)
+        futures = []
+
+        def insert(k):
+            futures.append(writer.insert({'k': k}))
+
+        with writer.batching():
+            threads = [threading.Thread(target=insert, args=(k,)) for k in range(4)]
+
+            for thread in threads:
+                thread.start()
+
+            for thread in threads:
+                thread.join()
+
+            for future in futures:
+                future.result(timeout=5)
+
+        self.assertEqual(collection.batches, [4])
+
+
+if __name__ == '__main__':
+    unittest.main()